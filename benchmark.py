@@ -0,0 +1,398 @@
+from datetime import datetime, timezone
+from termcolor import colored
+from typing import Dict, List, Optional
+import asyncio
+import click
+import json
+import subprocess
+import time
+
+from server.config import AppConfig, load_app_config
+from server.utils import generate_id
+
+DEFAULT_LLM_RESPONSE = (
+    "Michael Jordan is a former professional basketball player. "
+    "He played fifteen seasons in the NBA and won six championships with the Chicago Bulls. "
+    "Many consider him the greatest basketball player of all time. "
+    "He is also known for his Air Jordan shoes."
+)
+STUB_TTS_SAMPLE_RATE = 22050
+STUB_TTS_CHARS_PER_SECOND = 15  # speech duration of the generated silence
+
+# Compared with '--baseline'. Lower is better for all
+BASELINE_KEYS = [
+    ("time_to_first_audio", "p50"),
+    ("time_to_first_audio", "p95"),
+    ("time_to_first_audio", "p99"),
+    ("response_time", "p50"),
+    ("response_time", "p95"),
+    ("response_time", "p99"),
+]
+
+
+class FakeOllamaServer:
+    """
+    Local stand-in for Ollama's `/api/generate`. Streams the `response`
+    word by word: waits `latency` seconds, then `token_rate` tokens/s.
+    """
+
+    def __init__(self, response: str, token_rate: float, latency: float):
+        self._tokens = [w + " " for w in response.split(" ")]
+        self._token_rate = token_rate
+        self._latency = latency
+        self._runner = None  # aiohttp.web.AppRunner
+        self.url = ""
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.add_routes([web.post("/api/generate", self._generate)])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "localhost", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _generate(self, request):
+        from aiohttp import web
+
+        body = await request.json()
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+
+        async def write(data):
+            data = {"model": body.get("model", ""), "created_at": "", **data}
+            await resp.write((json.dumps(data) + "\n").encode("utf-8"))
+
+        await asyncio.sleep(self._latency)
+        for token in self._tokens:
+            await write({"response": token, "done": False})
+            await asyncio.sleep(1 / self._token_rate)
+        done = {"response": "", "done": True}
+        if not body.get("raw"):
+            done["context"] = [1, 2, 3]  # like Ollama, there is no context in raw mode
+        await write(done)
+        await resp.write_eof()
+        return resp
+
+
+class _StubSynthesizer:
+    output_sample_rate = STUB_TTS_SAMPLE_RATE
+
+    def __init__(self):
+        import pysbd
+
+        self._segmenter = pysbd.Segmenter(language="en", clean=True)
+
+    def split_into_sentences(self, text: str):
+        return self._segmenter.segment(text)
+
+
+class StubTTS:
+    """
+    Same API as `TTS` (like `FakeTTSWithRawXTTS2`). Returns silence,
+    blocks the TTS worker for `rtf` * audio duration.
+    """
+
+    is_multi_speaker = False
+    is_multi_lingual = False
+
+    def __init__(self, rtf: float):
+        self._rtf = rtf
+        self.synthesizer = _StubSynthesizer()
+
+    def tts(self, text: str, **kwargs):
+        import numpy as np
+
+        audio_seconds = max(len(text), 1) / STUB_TTS_CHARS_PER_SECOND
+        time.sleep(audio_seconds * self._rtf)
+        return np.zeros(int(audio_seconds * STUB_TTS_SAMPLE_RATE), dtype=np.float32)
+
+
+class QueryResult:
+    def __init__(self):
+        self.time_to_first_audio: Optional[float] = None
+        self.response_time: Optional[float] = None
+        self.audio_seconds = 0.0
+        self.frame_gaps = 0
+        self.error: Optional[str] = None
+
+
+async def run_client(url: str, queries: int, timeout: float, frame_delay: float):
+    """Sends `queries` one after another, like the web UI. Returns `QueryResult`s"""
+    import aiohttp
+    from server.audio_framing import FRAME_HEADER, decode_frame_header
+
+    results: List[QueryResult] = []
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(f"{url}/?audio=pcm16") as ws:
+            for i in range(queries):
+                msg_id = generate_id()
+                result = QueryResult()
+                results.append(result)
+                sentence_idx, next_seq = 0, 0  # expected next frame
+                start = time.perf_counter()
+                await ws.send_json(
+                    {"type": "query", "text": f"Question {i}?", "msgId": msg_id}
+                )
+                try:
+                    while True:
+                        msg = await asyncio.wait_for(ws.receive(), timeout)
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            data = json.loads(msg.data)
+                            msg_type = data.get("type")
+                            is_error = msg_type in ("error", "cancelled")
+                            if is_error and data.get("msgId") == msg_id:
+                                result.error = data.get("error", msg_type)
+                                break
+                            continue
+                        if msg.type != aiohttp.WSMsgType.BINARY:
+                            result.error = f"Websocket closed ({msg.type})"
+                            return results
+
+                        header = decode_frame_header(msg.data)
+                        if header["msg_id"] != msg_id:
+                            continue  # late frame of the previous query
+                        if result.time_to_first_audio is None:
+                            result.time_to_first_audio = time.perf_counter() - start
+                        if header["end_of_utterance"]:
+                            result.response_time = time.perf_counter() - start
+                            break
+
+                        if header["sentence_idx"] != sentence_idx:
+                            sentence_idx, next_seq = header["sentence_idx"], 0
+                        # chunks dropped by the server's send queue
+                        result.frame_gaps += max(header["seq"] - next_seq, 0)
+                        next_seq = header["seq"] + 1
+                        pcm_bytes = len(msg.data) - FRAME_HEADER.size
+                        result.audio_seconds += pcm_bytes / 2 / header["sample_rate"]
+                        if frame_delay > 0:
+                            await asyncio.sleep(frame_delay)  # slow client
+                except asyncio.TimeoutError:
+                    result.error = f"No response in {timeout}s"
+    return results
+
+
+def percentiles(values: List[float]):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pct(p: float):
+        # linear interpolation between closest ranks
+        k = (len(values) - 1) * p
+        lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+    return {
+        "p50": pct(0.5),
+        "p95": pct(0.95),
+        "p99": pct(0.99),
+        "mean": sum(values) / len(values),
+        "max": values[-1],
+    }
+
+
+def get_git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except Exception:
+        return None
+
+
+def summarize(results: List[QueryResult], elapsed: float, dropped_frames: int):
+    ok = [r for r in results if r.error is None and r.response_time is not None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    audio_seconds = sum(r.audio_seconds for r in results)
+    return {
+        "queries": len(results),
+        "completed": len(ok),
+        "errors": errors,
+        "elapsed": elapsed,
+        "time_to_first_audio": percentiles(
+            [r.time_to_first_audio for r in ok if r.time_to_first_audio is not None]
+        ),
+        "response_time": percentiles([r.response_time for r in ok]),  # type: ignore
+        "throughput": {
+            "queries_per_second": len(ok) / elapsed,
+            "audio_seconds_per_second": audio_seconds / elapsed,
+        },
+        "dropped_frames": dropped_frames,
+        "frame_gaps": sum(r.frame_gaps for r in results),
+    }
+
+
+def print_baseline_comparison(result: dict, baseline_path: str):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    commit = baseline.get("commit")
+    print(colored("Compared to:", "blue"), f"'{baseline_path}' ({commit})")
+    for group, key in BASELINE_KEYS:
+        old = (baseline["results"].get(group) or {}).get(key)
+        new = (result["results"].get(group) or {}).get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / max(old, 1e-9) * 100
+        color = "red" if change > 5 else "green" if change < -5 else None
+        print(
+            f"  {group}.{key}: {old:.3f}s -> {new:.3f}s",
+            colored(f"({change:+.1f}%)", color),  # type: ignore
+        )
+
+
+async def run_benchmark(cfg: AppConfig, params: dict):
+    from aiohttp import web
+    from ollama import AsyncClient
+    from server.app_logic import AppLogic
+    from server.send_queue import SEND_QUEUE_STATS
+    from server.server import create_server
+    from server.socket_msg_handler import SocketMsgHandler
+    from server.tts_utils import create_tts
+
+    llm_server = FakeOllamaServer(
+        DEFAULT_LLM_RESPONSE, params["token_rate"], params["llm_latency_ms"] / 1000
+    )
+    await llm_server.start()
+    cfg.llm.api = llm_server.url
+    cfg.llm.mocked_response = None
+
+    if params["tts"] == "stub":
+        cfg.tts.processes = 0  # worker processes would load the real model
+        tts = StubTTS(params["tts_rtf"])
+    else:
+        tts = create_tts(cfg) if not cfg.tts.processes else None
+    app_logic = AppLogic(cfg, AsyncClient(cfg.llm.api), tts)  # type: ignore
+
+    create_ws_handler = (
+        lambda ws, is_unity, audio_format, visemes: SocketMsgHandler(
+            ws, app_logic, is_unity, audio_format, visemes
+        )
+    )
+    app = create_server("./server/static", create_ws_handler, app_logic)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "localhost", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    url = f"http://{host}:{port}"
+
+    dropped_before = SEND_QUEUE_STATS.dropped_audio_chunks
+    start = time.perf_counter()
+    try:
+        client_results = await asyncio.gather(
+            *[
+                run_client(
+                    url,
+                    params["queries"],
+                    params["timeout"],
+                    params["client_frame_delay_ms"] / 1000,
+                )
+                for _ in range(params["clients"])
+            ]
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        await runner.cleanup()
+        await llm_server.stop()
+
+    results = [r for client in client_results for r in client]
+    dropped = SEND_QUEUE_STATS.dropped_audio_chunks - dropped_before
+    return summarize(results, elapsed, dropped)
+
+
+@click.command()
+@click.option("--config", "-c", type=click.Path(exists=True), help="Config file")
+@click.option("--clients", "-n", default=4, help="Concurrent websocket clients")
+@click.option("--queries", "-q", default=5, help="Queries sent by each client")
+@click.option("--token-rate", default=50.0, help="Fake LLM tokens per second")
+@click.option("--llm-latency-ms", default=200.0, help="Fake LLM time to first token")
+@click.option(
+    "--tts",
+    type=click.Choice(["stub", "real"]),
+    default="stub",
+    help="'real' loads the TTS model from the config",
+)
+@click.option("--tts-rtf", default=0.2, help="Real-time factor of the stub TTS")
+@click.option(
+    "--tts-cache", is_flag=True, help="Keep TTS cache on (repeated responses)"
+)
+@click.option(
+    "--client-frame-delay-ms", default=0.0, help="Simulate slow clients"
+)
+@click.option("--timeout", default=60.0, help="Max seconds to wait for each query")
+@click.option("--output", "-o", type=click.Path(), help="Write JSON results to file")
+@click.option(
+    "--baseline",
+    "-b",
+    type=click.Path(exists=True),
+    help="Previous results, print the difference",
+)
+def benchmark(
+    config: Optional[str],
+    clients: int,
+    queries: int,
+    token_rate: float,
+    llm_latency_ms: float,
+    tts: str,
+    tts_rtf: float,
+    tts_cache: bool,
+    client_frame_delay_ms: float,
+    timeout: float,
+    output: Optional[str],
+    baseline: Optional[str],
+):
+    """End-to-end latency benchmark with a local fake Ollama server"""
+
+    cfg = load_app_config(config)
+    cfg.tts.cache.enabled = tts_cache
+    params = {
+        "clients": clients,
+        "queries": queries,
+        "token_rate": token_rate,
+        "llm_latency_ms": llm_latency_ms,
+        "tts": tts,
+        "tts_rtf": tts_rtf,
+        "tts_cache": tts_cache,
+        "client_frame_delay_ms": client_frame_delay_ms,
+        "timeout": timeout,
+    }
+    print(colored("Benchmark:", "blue"), params)
+
+    results = asyncio.run(run_benchmark(cfg, params))
+    result = {
+        "commit": get_git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "params": params,
+        "config": {
+            "tts_model": cfg.tts.model_name if tts == "real" else "stub",
+            "tts_workers": cfg.tts.workers,
+            "tts_processes": cfg.tts.processes,
+            "tts_streaming": cfg.tts.streaming_enabled,
+            "send_overflow": cfg.server.send_overflow,
+        },
+        "results": results,
+    }
+
+    result_json = json.dumps(result, indent=2)
+    print(result_json)
+    if output:
+        with open(output, "w") as f:
+            f.write(result_json)
+        print(colored("Results written to:", "green"), f"'{output}'")
+    if baseline:
+        print_baseline_comparison(result, baseline)
@@ -1,10 +1,18 @@
 from termcolor import colored
-from ollama import AsyncClient
 import click
 
+# Keep this file light. Heavy dependencies (torch, TTS, ollama, aiohttp)
+# are imported inside the commands that need them, so that e.g.
+# '--help' or 'validate-config' start fast. See 'check-startup'.
 from server.config import load_app_config
-from server.tts_utils import create_tts
-from xtts_scripts import create_speaker_samples, speak
+from xtts_scripts import (
+    create_speaker_samples,
+    speak,
+    precompute_speaker_latents,
+    prepare_xtts,
+)
+from benchmark import benchmark
+from startup_check import check_startup
 
 DEFAULT_TTS_TEXT = "The current algorithm only upscales the luma, the chroma is preserved as-is. This is a common trick known"
 
@@ -18,9 +26,11 @@ def serve(config: str):
     import sys
     import platform
     import torch
+    from ollama import AsyncClient
     from server.server import create_server, start_server
     from server.socket_msg_handler import SocketMsgHandler
     from server.app_logic import AppLogic
+    from server.tts_utils import create_tts
 
     STATIC_DIR = "./server/static"
 
@@ -31,12 +41,19 @@ def serve(config: str):
     print(colored("Torch:", "blue"), f"{torch.__version__}")
 
     llm = AsyncClient(cfg.llm.api)
-    tts = create_tts(cfg)
+    # with TTS worker processes, each process loads its own model
+    tts = create_tts(cfg) if not cfg.tts.processes else None
     app_logic = AppLogic(cfg, llm, tts)
 
     # create server and set socket handlers
-    create_ws_handler = lambda ws, is_unity: SocketMsgHandler(ws, app_logic, is_unity)
-    app = create_server(STATIC_DIR, create_ws_handler, app_logic)
+    create_ws_handler = (
+        lambda ws, is_unity, audio_format, visemes: SocketMsgHandler(
+            ws, app_logic, is_unity, audio_format, visemes
+        )
+    )
+    app = create_server(
+        STATIC_DIR, create_ws_handler, app_logic, warm_up_text=DEFAULT_TTS_TEXT
+    )
 
     # START!
     print(colored("Webui:", "green"), f"http://{cfg.server.host}:{cfg.server.port}/ui")
@@ -45,6 +62,32 @@ def serve(config: str):
     print("=== DONE ===")
 
 
+@click.command()
+@click.option(
+    "--config", "-c", type=click.Path(exists=True), required=True, help="Config file"
+)
+def validate_config(config: str):
+    """Check the config file without loading any models"""
+    import os.path
+    from pydantic import ValidationError
+    from yaml import YAMLError
+
+    try:
+        cfg = load_app_config(config)
+    except (ValidationError, YAMLError, TypeError) as e:
+        print(colored("Invalid config:", "red"), e)
+        exit(1)
+
+    files = {
+        "tts.sample_of_cloned_voice_wav": cfg.tts.sample_of_cloned_voice_wav,
+        "tts.speaker_latents_file": cfg.tts.speaker_latents_file,
+    }
+    for key, filepath in files.items():
+        if filepath and not os.path.exists(filepath):
+            print(colored(f"File not found ({key}):", "yellow"), f"'{filepath}'")
+    print(colored("Config OK:", "green"), f"'{config}'")
+
+
 @click.group()
 def main():
     """Available commands below"""
@@ -52,6 +95,11 @@ def main():
 
 if __name__ == "__main__":
     main.add_command(serve)
+    main.add_command(validate_config)
     main.add_command(create_speaker_samples)
     main.add_command(speak)
+    main.add_command(precompute_speaker_latents)
+    main.add_command(prepare_xtts)
+    main.add_command(benchmark)
+    main.add_command(check_startup)
     main()
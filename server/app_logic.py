@@ -1,14 +1,33 @@
 from TTS.api import TTS
 from termcolor import colored
 from ollama import AsyncClient as OllamaAsyncClient
-from typing import Optional
-import types
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set
+from collections import deque
 import asyncio
+import time
 
+from server.audio_framing import AudioChunk
 from server.config import AppConfig
-from server.tts_utils import exec_tts, wav2bytes, wav2bytes_streamed
+from server.json_message import JsonMessage
+from server.metrics import METRICS
+from server.tts_executor import TtsExecutor
 from server.signal import Signal
-from server.utils import Timer, generate_id
+from server.chat_sessions import ChatSessionStore
+from server.sentence_stream import SentenceStream
+from server.tracing import Tracer
+from server.utils import Timer, estimate_tokens, generate_id
+
+
+# Go template that renders only the prompt, instead of the model's chat template
+OLLAMA_PROMPT_TEMPLATE = "{{ .Prompt }}"
+
+
+class QueryCancelledError(Exception):
+    """Query was cancelled by a newer query, context reset, or disconnect"""
+
+    def __init__(self, msg_id: str):
+        super().__init__(f"Query '{msg_id}' was cancelled")
+        self.msg_id = msg_id
 
 
 class GemmaChatContext:
@@ -19,35 +38,109 @@ class GemmaChatContext:
 
     def __init__(self, cfg: AppConfig):
         self.cfg = cfg
-        self.history = []
+        self.history: Deque[str] = deque()
+        # token count of each history entry, calculated once when added
+        self._turn_tokens: Deque[int] = deque()
+        self._history_tokens = 0
+        self._sys_prompt = GemmaChatContext._create_system_prompt(cfg)
+        self._sys_prompt_tokens = estimate_tokens(self._sys_prompt)
+        self._last_query = ""
+        # Ollama's 'context' (tokens of the conversation so far) returned
+        # after the last response. Allows to send only the new user query.
+        self.llm_context: Optional[List[int]] = None
+        self._llm_context_turns = 0  # history entries that are in llm_context
+        # incremented on `reset()`. Responses of older queries are not added
+        self.generation = 0
 
     def add_user_query(self, query):
-        self.history.append(GemmaChatContext.USER_CHAT_TEMPLATE.format(prompt=query))
+        self._last_query = query
+        self._add_turn(GemmaChatContext.USER_CHAT_TEMPLATE.format(prompt=query))
 
     def add_model_response(self, resp):
-        self.history.append(GemmaChatContext.MODEL_CHAT_TEMPLATE.format(prompt=resp))
+        if len(self.history) == self._llm_context_turns:
+            self._llm_context_turns += 1  # response is already in llm_context
+        self._add_turn(GemmaChatContext.MODEL_CHAT_TEMPLATE.format(prompt=resp))
+
+    def set_llm_context(self, llm_context: Optional[List[int]]):
+        """Call with the context after the LLM has finished the response"""
+        self.llm_context = llm_context
+        self._llm_context_turns = len(self.history)
 
     def reset(self):
-        self.history = []
+        self.generation += 1
+        self.history.clear()
+        self._turn_tokens.clear()
+        self._history_tokens = 0
+        self.set_llm_context(None)
+
+    def memory_usage(self):
+        ctx_size = 8 * len(self.llm_context) if self.llm_context else 0
+        return ctx_size + sum(len(turn) for turn in self.history)
+
+    @property
+    def prompt_tokens(self):
+        """Estimated token count of the full prompt"""
+        return self._sys_prompt_tokens + self._history_tokens
+
+    def can_reuse_llm_context(self):
+        """
+        True if only the last user query is not in the `llm_context` and
+        the history would not be truncated (otherwise, rebuild the prompt).
+        """
+        if self.llm_context is None:
+            return False
+        if len(self.history) != self._llm_context_turns + 1:
+            return False
+        return self.cfg.llm.context_length > 0 and not self._needs_truncation(
+            *self._history_limits()
+        )
+
+    def generate_incremental_prompt(self):
+        """
+        Use together with `llm_context`. It ends with the generated response,
+        so close the model's turn, then add the new user turn.
+        """
+        user_turn = GemmaChatContext.USER_CHAT_TEMPLATE.format(prompt=self._last_query)
+        return "<end_of_turn>\n" + user_turn + "<start_of_turn>model\n"
 
     def generate_prompt(self):
-        ctx_len = self.cfg.llm.context_length
-        if ctx_len > 0:
-            self.history = self.history[-ctx_len * 2 :]
-        else:
-            self.history = self.history[-1:]
+        # full rebuild, previous llm_context no longer matches the prompt
+        self.set_llm_context(None)
+
+        max_turns, max_tokens = self._history_limits()
+        # drop oldest turns, always keep the current query
+        while len(self.history) > 1 and self._needs_truncation(max_turns, max_tokens):
+            self.history.popleft()
+            self._history_tokens -= self._turn_tokens.popleft()
         context = "".join(self.history)
 
-        system_message = self.cfg.llm.system_message
+        return self._sys_prompt + context + "<start_of_turn>model\n"
+
+    def _add_turn(self, text: str):
+        tokens = estimate_tokens(text)
+        self.history.append(text)
+        self._turn_tokens.append(tokens)
+        self._history_tokens += tokens
+
+    def _history_limits(self):
+        """Returns max history entries and max prompt tokens (0 means no limit)"""
+        ctx_len = self.cfg.llm.context_length
+        max_turns = ctx_len * 2 if ctx_len > 0 else 1
+        return max_turns, self.cfg.llm.context_tokens
+
+    def _needs_truncation(self, max_turns: int, max_tokens: int):
+        if len(self.history) > max_turns:
+            return True
+        return max_tokens > 0 and self.prompt_tokens > max_tokens
+
+    @staticmethod
+    def _create_system_prompt(cfg: AppConfig):
+        system_message = cfg.llm.system_message
         system_message = system_message if isinstance(system_message, str) else ""
         system_message = system_message.strip()
-        sys_prompt = ""
-        if len(system_message) > 0:
-            sys_prompt = GemmaChatContext.USER_CHAT_TEMPLATE.format(
-                prompt=system_message
-            )
-
-        return sys_prompt + context + "<start_of_turn>model\n"
+        if len(system_message) == 0:
+            return ""
+        return GemmaChatContext.USER_CHAT_TEMPLATE.format(prompt=system_message)
 
 
 class AppLogic:
@@ -63,48 +156,274 @@ class AppLogic:
         self,
         cfg: AppConfig,
         llm: OllamaAsyncClient,
-        tts: TTS,
+        tts: Optional[TTS],
     ):
         self.cfg = cfg
         self.llm = llm
         self._tts = tts
-        self.chat_context = GemmaChatContext(cfg)
-
-        self.on_query = Signal()
-        self.on_text_response = Signal()
-        self.on_tts_response = Signal()
-        self.on_tts_timings = Signal()
-        self.on_tts_first_chunk = Signal()
-        self.on_play_vfx = Signal()
+        self.tracer = Tracer(cfg.tracing)
+        self._tts_executor = TtsExecutor(cfg, tts, self.tracer)
+        self.sessions = ChatSessionStore(cfg.session, lambda: GemmaChatContext(cfg))
+        # in-flight LLM/TTS tasks for each msg_id
+        self._requests: Dict[str, Set[asyncio.Task]] = {}
+        # msg_id of the last query for each session
+        self._session_requests: Dict[str, str] = {}
+        self.warming_up = False
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+        # receivers only queue the message for each client, see `ClientSendQueue`
+        self.on_query = Signal(concurrent=True)
+        self.on_text_token = Signal(concurrent=True)  # LLM text deltas
+        self.on_text_response = Signal(concurrent=True)
+        self.on_tts_response = Signal(concurrent=True)
+        self.on_tts_timings = Signal(concurrent=True)
+        self.on_tts_first_chunk = Signal(concurrent=True)
+        self.on_play_vfx = Signal(concurrent=True)
+
+        METRICS.gauge(
+            "iris_in_flight_requests",
+            "Queries with LLM or TTS still running",
+            lambda: len(self._requests),
+        )
+        METRICS.gauge(
+            "iris_tts_queue_depth",
+            "Sentences waiting for a TTS worker",
+            lambda: self._tts_executor.queue.pending_count,
+        )
+        METRICS.gauge(
+            "iris_sessions", "Chat sessions in memory", lambda: len(self.sessions)
+        )
 
-    async def ask_query(self, query: str, msg_id: Optional[str] = ""):
+    async def ask_query(
+        self,
+        query: str,
+        msg_id: Optional[str] = "",
+        session_id: Optional[str] = None,
+    ):
+        """
+        If `session_id` is None, the query is answered without any chat history.
+        A new query from the same session cancels the previous one
+        (raises `QueryCancelledError` for the previous one).
+        """
         if not msg_id:
             msg_id = generate_id()
-        print(colored("Query:", "blue"), f"'{query}' (msg_id={msg_id})")
-        await self.on_query.send(query, msg_id)
-        self.chat_context.add_user_query(query)
+        print(
+            colored("Query:", "blue"),
+            f"'{query}' (msg_id={msg_id}, session_id={session_id})",
+        )
+        self.tracer.start_trace(msg_id, session_id=session_id or "", query=query)
+        if session_id is not None:
+            # barge-in. User asked something else before we finished
+            self.cancel_session(session_id)
+            self._session_requests[session_id] = msg_id
+
+        task = asyncio.create_task(self._ask_query(query, msg_id, session_id))
+        self._track_task(msg_id, task)
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            self.cancel(msg_id)  # e.g. the caller has disconnected
+            raise
+
+        if task.cancelled():
+            raise QueryCancelledError(msg_id)
+        return task.result()
+
+    async def _ask_query(self, query: str, msg_id: str, session_id: Optional[str]):
+        await self.on_query.send(
+            JsonMessage({"type": "query", "msgId": msg_id, "text": query})
+        )
+        chat_context = self.sessions.get(session_id).chat_context
+        chat_context.add_user_query(query)
+        generation = chat_context.generation
 
         time_to_first_tts = Timer(start=True)
 
-        with Timer() as llm_timer:
-            resp_text = await self._exec_llm(query)
-            self.chat_context.add_model_response(resp_text)
-        await self.on_text_response.send(resp_text, msg_id, llm_timer.delta)
-
-        # internally can use different thread
-        await self._exec_tts(resp_text, msg_id, time_to_first_tts)
+        # TTS starts on the first complete sentence, while LLM is still generating
+        sentences = self._exec_tts(msg_id, session_id, time_to_first_tts)
+        sentence_stream = SentenceStream(self._tts_executor.split_into_sentences)
+
+        llm_start = time.time_ns()
+        tokens = 0
+        try:
+            with Timer() as llm_timer:
+                async for token in self._exec_llm(query, chat_context):
+                    if tokens == 0:
+                        now_ns = time.time_ns()
+                        METRICS.llm_first_token.observe((now_ns - llm_start) / 1e9)
+                        self.tracer.add_span(
+                            msg_id, "llm.first_token", llm_start, now_ns
+                        )
+                    tokens += 1
+                    if self.on_text_token:
+                        data = {"type": "text-delta", "msgId": msg_id, "text": token}
+                        await self.on_text_token.send(JsonMessage(data))
+                    for sentence in sentence_stream.push(token):
+                        self._queue_sentence(sentences, sentence)
+                for sentence in sentence_stream.flush():
+                    self._queue_sentence(sentences, sentence)
+            METRICS.llm_seconds.observe(llm_timer.delta)
+            self.tracer.add_span(
+                msg_id,
+                "llm",
+                llm_start,
+                tokens=tokens,
+                sentence_split_seconds=sentence_stream.split_seconds,
+            )
+        except asyncio.CancelledError:
+            # Remember what the user has (partially) heard. Unless cancelled
+            # by `reset_context()`, that already started a new conversation
+            if sentence_stream.text and chat_context.generation == generation:
+                chat_context.add_model_response(sentence_stream.text)
+            raise
+        finally:
+            self._queue_sentence(sentences, None)  # no more sentences
+
+        resp_text = sentence_stream.text
+        chat_context.add_model_response(resp_text)
+        data = {
+            "type": "done",
+            "msgId": msg_id,
+            "text": resp_text,
+            "elapsed_llm": llm_timer.delta,
+        }
+        if self.cfg.verbose:
+            print(data)
+        await self.on_text_response.send(JsonMessage(data))
+
+        if sentences is None:
+            # skipped TTS as there were no event listeners
+            await self._send_tts_timings(msg_id, 0)
+            await self._send_tts_first_chunk(msg_id, 0)
 
         return resp_text
 
+    def stats(self):
+        cache = self._tts_executor.cache
+        return {
+            "sessions": len(self.sessions),
+            "in_flight_requests": len(self._requests),
+            "tts_cache": cache.stats() if cache else None,
+            "tts_queue": self._tts_executor.queue.stats.to_dict(),
+            "tts_processes": self._tts_executor.pool_stats(),
+        }
+
+    def start_warm_up(self, text: str):
+        """Start `warm_up()` in the background, if enabled in the config"""
+        if not self.cfg.warmup.enabled or self._warm_up_task is not None:
+            return
+        self.warming_up = True  # right away, `/status` is served before the task runs
+        self._warm_up_task = asyncio.create_task(self.warm_up(text))
+
+    async def warm_up(self, text: str):
+        """
+        Dummy LLM and TTS passes, so that the first real query does not pay
+        for model loading, CUDA kernel init, sentence splitter setup etc.
+        """
+        self.warming_up = True
+        print(colored("Warm-up:", "blue"), "started")
+        try:
+            with Timer() as timer:
+                await asyncio.gather(self._warm_up_llm(), self._warm_up_tts(text))
+            print(colored("Warm-up:", "green"), f"done in {timer}")
+        finally:
+            self.warming_up = False
+
+    async def _warm_up_llm(self):
+        cfg = self.cfg.llm
+        if not self.cfg.warmup.llm or isinstance(cfg.mocked_response, str):
+            return
+        try:
+            with Timer() as timer:
+                # empty prompt only loads the model
+                await self.llm.generate(
+                    model=cfg.model, prompt="", keep_alive=cfg.keep_alive
+                )
+                await self.llm.generate(
+                    model=cfg.model,
+                    prompt="Hi",
+                    options={"num_predict": 1},
+                    keep_alive=cfg.keep_alive,
+                )
+            print(colored("Warm-up LLM:", "blue"), f"'{cfg.model}' in {timer}")
+        except Exception as e:
+            print(colored("Warm-up LLM failed:", "red"), e)
+
+    async def _warm_up_tts(self, text: str):
+        if not self.cfg.warmup.tts:
+            return
+        try:
+            with Timer() as timer:
+                # e.g. pysbd/spaCy setup on the first call
+                self._tts_executor.split_into_sentences(text)
+                await self._tts_executor.warm_up(text)
+            print(colored("Warm-up TTS:", "blue"), f"done in {timer}")
+        except Exception as e:
+            print(colored("Warm-up TTS failed:", "red"), e)
+
+    def shutdown(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+        self._tts_executor.shutdown()
+
+    def is_running(self, msg_id: str):
+        """True if LLM or TTS are still working on the query"""
+        return msg_id in self._requests
+
+    def cancel(self, msg_id: str):
+        """Stop both LLM and TTS for the query. TTS stops after the current chunk"""
+        tasks = self._requests.pop(msg_id, set())
+        self._forget_session_request(msg_id)
+        if tasks:
+            print(colored("Cancelled:", "yellow"), f"msg_id={msg_id}")
+            self.tracer.end_trace(msg_id, cancelled=True)
+        for task in tasks:
+            task.cancel()
+
+    def cancel_session(self, session_id: Optional[str]):
+        msg_id = self._session_requests.pop(session_id, None)
+        if msg_id is not None:
+            self.cancel(msg_id)
+
+    def _track_task(self, msg_id: str, task: asyncio.Task):
+        """Remember task for cancellation. Also keeps the reference, so it's not GC'ed"""
+        tasks = self._requests.setdefault(msg_id, set())
+        tasks.add(task)
+
+        def on_done(task):
+            tasks.discard(task)
+            if not tasks and self._requests.get(msg_id) is tasks:
+                del self._requests[msg_id]
+                self._forget_session_request(msg_id)
+                self.tracer.end_trace(msg_id)  # both LLM and TTS are done
+
+        task.add_done_callback(on_done)
+
+    def _forget_session_request(self, msg_id: str):
+        for session_id, session_msg_id in list(self._session_requests.items()):
+            if session_msg_id == msg_id:
+                del self._session_requests[session_id]
+
     async def play_vfx(self, vfx: str):
         print(colored("VFX (particle system):", "blue"), f"'{vfx}'")
-        await self.on_play_vfx.send(vfx)
+        await self.on_play_vfx.send(JsonMessage({"type": "play-vfx", "vfx": vfx}))
 
-    def reset_context(self):
-        self.chat_context.reset()
+    def reset_context(self, session_id: Optional[str]):
+        self.cancel_session(session_id)
+        if session_id in self.sessions:
+            self.sessions.get(session_id).chat_context.reset()
 
-    async def _exec_llm(self, query: str) -> str:
-        """If this fn returns nothing, just restart ollama"""
+    def close_session(self, session_id: Optional[str]):
+        self.cancel_session(session_id)
+        self.sessions.remove(session_id)
+
+    async def _exec_llm(
+        self, query: str, chat_context: GemmaChatContext
+    ) -> AsyncIterator[str]:
+        """
+        Yields response tokens as they are generated.
+        If this fn returns nothing, just restart ollama.
+        """
 
         cfg = self.cfg.llm
         if isinstance(cfg.mocked_response, str):
@@ -112,15 +431,28 @@ class AppLogic:
                 colored("Mocked LLM response based on config:", "blue"),
                 f"'{cfg.mocked_response}'",
             )
-            return query if cfg.mocked_response == "" else cfg.mocked_response
+            yield query if cfg.mocked_response == "" else cfg.mocked_response
+            return
 
-        prompt = self.chat_context.generate_prompt()
+        llm_context = None
+        if cfg.reuse_context and chat_context.can_reuse_llm_context():
+            # Ollama still has KV-cache for the tokens in the context
+            prompt = chat_context.generate_incremental_prompt()
+            llm_context = chat_context.llm_context
+        else:
+            prompt = chat_context.generate_prompt()
         # print(colored(prompt, "yellow"))
 
         # https://github.com/ollama/ollama/blob/main/docs/api.md#generate-a-completion
-        resp = await self.llm.generate(
+        stream = await self.llm.generate(
             model=cfg.model,
             prompt=prompt,
+            context=llm_context,
+            stream=True,
+            # The prompt is already in Gemma's chat format, use it as-is. Not
+            # 'raw', Ollama neither returns nor accepts the 'context' with it
+            template=OLLAMA_PROMPT_TEMPLATE,
+            keep_alive=cfg.keep_alive,
             # https://github.com/ollama/ollama/blob/main/docs/modelfile.md#valid-parameters-and-values
             options={
                 "temperature": self.cfg.llm.temperature,
@@ -128,52 +460,121 @@ class AppLogic:
                 "top_p": self.cfg.llm.top_p,
             },
         )
-        return resp.get("response")
-
-    async def _exec_tts(self, text: str, msg_id: str, time_to_first_tts: Timer):
+        async for part in stream:
+            token = part.get("response", "")
+            if token:
+                yield token
+            if part.get("done") and cfg.reuse_context:
+                chat_context.set_llm_context(part.get("context"))
+
+    def _exec_tts(
+        self, msg_id: str, session_id: Optional[str], time_to_first_tts: Timer
+    ) -> Optional[asyncio.Queue]:
+        """
+        Start TTS task that consumes sentences from the returned queue.
+        Put `None` into the queue after the last sentence.
+        """
         # skip if no event listeners
         if not self.on_tts_response:
-            await self.on_tts_timings.send(msg_id, 0)
-            await self.on_tts_first_chunk.send(msg_id, 0)
-            return
+            return None
 
-        # split into sentences to lower time to first chunk
-        sentences = self._tts.synthesizer.split_into_sentences(text)
+        sentences: asyncio.Queue = asyncio.Queue()
 
         async def tts_internal():
-            with Timer() as tts_timer:
-                for sentence in sentences:
-                    await self._tts_sentence(sentence)
-                    await self._time_first_audio_chunk(msg_id, time_to_first_tts)
+            elapsed_tts = 0.0
+            sentence_idx = 0
+            try:
+                while True:
+                    sentence = await sentences.get()
+                    if sentence is None:
+                        break
+                    with Timer() as tts_timer:
+                        await self._tts_sentence(
+                            sentence,
+                            msg_id,
+                            session_id,
+                            sentence_idx,
+                            time_to_first_tts,
+                        )
+                    elapsed_tts += tts_timer.delta
+                    sentence_idx += 1
+            finally:
+                # Mark end of utterance, also if cancelled. Clients (and their
+                # per-utterance Opus state) know that no more audio is coming
+                sample_rate = self._tts_executor.sample_rate
+                end = AudioChunk(msg_id, sentence_idx, 0, sample_rate, b"", True)
+                await self.on_tts_response.send(end)
 
             # tts done, send timings
-            await self.on_tts_timings.send(msg_id, tts_timer.delta)
+            await self._send_tts_timings(msg_id, elapsed_tts)
 
-        loop = asyncio.get_running_loop()
-        loop.create_task(tts_internal())
+        task = asyncio.get_running_loop().create_task(tts_internal())
+        self._track_task(msg_id, task)
+        return sentences
 
-    async def _tts_sentence(self, sentence: str):
-        output = exec_tts(self.cfg, self._tts, sentence)  # either object or generator
+    def _queue_sentence(self, sentences: Optional[asyncio.Queue], sentence):
+        if sentences is not None:
+            sentences.put_nowait(sentence)
 
-        if not isinstance(output, types.GeneratorType):
-            # when not streaming
-            bytes = wav2bytes(self._tts, output)
-            await self.on_tts_response.send(bytes)  # send to client
-        else:
-            # when streaming
-            for i, chunk in enumerate(output):
-                bytes = wav2bytes_streamed(self._tts, chunk)
-                # print(colored(f"raw_chunk_{i}", "yellow"), "sending")
-                await self.on_tts_response.send(bytes)  # send to client
-                # print(colored(f"raw_chunk_{i}", "yellow"), "send success")
+    async def _tts_sentence(
+        self,
+        sentence: str,
+        msg_id: str,
+        session_id: Optional[str],
+        sentence_idx: int,
+        time_to_first_tts: Timer,
+    ):
+        # runs on the TTS worker thread. Either a single PCM or many streamed chunks
+        sample_rate = self._tts_executor.sample_rate
+        seq = 0
+        audio_bytes = 0
+        start_ns = time.time_ns()
+        session_key = session_id or msg_id  # for fair TTS scheduling
+        synthesized = self._tts_executor.synthesize(sentence, session_key, msg_id)
+        async for pcm in synthesized:
+            chunk = AudioChunk(msg_id, sentence_idx, seq, sample_rate, pcm)
+            await self.on_tts_response.send(chunk)  # send to client
+            await self._time_first_audio_chunk(msg_id, time_to_first_tts)
+            seq += 1
+            audio_bytes += len(pcm)
+
+        # includes the TTS queue wait, see 'tts.synthesize' span for the inference
+        end_ns = time.time_ns()
+        METRICS.tts_sentence_seconds.observe((end_ns - start_ns) / 1e9)
+        self.tracer.add_span(
+            msg_id,
+            "tts.sentence",
+            start_ns,
+            end_ns,
+            sentence_idx=sentence_idx,
+            chunks=seq,
+            audio_seconds=audio_bytes / 2 / sample_rate,  # int16
+        )
 
     async def _time_first_audio_chunk(self, msg_id: str, time_to_first_tts: Timer):
         if not time_to_first_tts.is_running():
             return
 
         delta = time_to_first_tts.stop()
-        await self.on_tts_first_chunk.send(msg_id, delta)
+        METRICS.time_to_first_audio.observe(delta)
+        await self._send_tts_first_chunk(msg_id, delta)
         print(
             colored("First TTS chunk:", "blue"),
             f"{time_to_first_tts.delta:.2f}s",
         )
+
+    async def _send_tts_timings(self, msg_id: str, elapsed_tts: float):
+        data = {
+            "type": "tts-elapsed",
+            "msgId": msg_id,
+            "elapsed_tts": elapsed_tts,
+        }
+        await self.on_tts_timings.send(JsonMessage(data))
+
+    async def _send_tts_first_chunk(self, msg_id: str, elapsed_tts: float):
+        data = {
+            "type": "tts-first-chunk",
+            "msgId": msg_id,
+            "first_chunk_tts": elapsed_tts,
+        }
+        await self.on_tts_first_chunk.send(JsonMessage(data))
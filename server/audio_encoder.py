@@ -0,0 +1,194 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from termcolor import colored
+from typing import Optional
+import struct
+import numpy as np
+
+from server.audio_framing import FRAME_FORMAT_OPUS, AudioChunk, encode_frame
+from server.utils import Timer
+
+# https://opus-codec.org/docs/opus_api-1.3.1/group__opus__encoder.html
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+OPUS_FRAME_MS = 20
+OPUS_PACKET_LEN = struct.Struct("<H")
+# Utterances of a connection with an encoder state. Oldest one is dropped
+# above it, in case its end of utterance never came (e.g. send queue closed)
+MAX_OPEN_STREAMS = 8
+
+
+def check_opus():
+    opus_available = False
+    try:
+        import opuslib
+
+        opus_available = True
+    except Exception:  # also raised if the native libopus is missing
+        pass
+    return opus_available
+
+
+class EncoderStats:
+    """Totals for all connections. Updated from the encoder threads (GIL is enough)"""
+
+    def __init__(self):
+        self.chunks = 0
+        self.audio_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_seconds = 0.0
+
+    def to_dict(self):
+        audio_sec = max(self.audio_seconds, 1e-6)
+        return {
+            "chunks": self.chunks,
+            "audio_seconds": self.audio_seconds,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bitrate_kbps": 8 * self.bytes_out / audio_sec / 1000,
+            "compression_ratio": self.bytes_in / max(self.bytes_out, 1),
+            "encode_seconds": self.encode_seconds,
+            "encode_realtime_factor": self.encode_seconds / audio_sec,
+        }
+
+
+OPUS_STATS = EncoderStats()
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_encoder_executor():
+    """Shared by all connections. Keeps the encoding off the event loop"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="audio_enc")
+    return _executor
+
+
+class _OpusStream:
+    """Encoder and resampler state of a single utterance (`msg_id`)"""
+
+    def __init__(self, sample_rate: int, bitrate: int, complexity: int):
+        import opuslib
+
+        self.in_rate = sample_rate
+        self.out_rate = sample_rate if sample_rate in OPUS_SAMPLE_RATES else 24000
+        self.encoder = opuslib.Encoder(self.out_rate, 1, opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = bitrate
+        self.encoder.complexity = complexity
+        self.pending = np.zeros(0, dtype=np.int16)
+        # resampler: input position of the next output sample (relative to
+        # the start of the next chunk) and the last input sample
+        self._resample_pos = 0.0
+        self._last_sample = 0.0
+
+    def resample(self, samples: np.ndarray):
+        """
+        Linear interpolation, continuous across chunks. The first output
+        sample may lie between the last sample of the previous chunk
+        and the first one of this chunk.
+        """
+        if self.in_rate == self.out_rate or len(samples) == 0:
+            return samples
+        step = self.in_rate / self.out_rate
+        pos = self._resample_pos
+        count = int(np.floor((len(samples) - 1 - pos) / step)) + 1
+        if count <= 0:
+            out = np.zeros(0, dtype=np.int16)
+        else:
+            x = pos + step * np.arange(count)
+            # index 0 is the last sample of the previous chunk
+            xp = np.arange(-1, len(samples))
+            fp = np.concatenate(([self._last_sample], samples))
+            out = np.round(np.interp(x, xp, fp)).astype(np.int16)
+        self._resample_pos = pos + step * max(count, 0) - len(samples)
+        self._last_sample = float(samples[-1])
+        return out
+
+
+class OpusStreamEncoder:
+    """
+    Encodes the TTS output of a single connection into Opus packets.
+    Stateful, chunks of each utterance have to be encoded in order.
+
+    Opus works on fixed 20ms frames. Samples that do not fill a whole
+    frame wait for the next chunk. The rest is padded with silence
+    at the end of utterance. Sample rates that Opus does not
+    support (e.g. 22050Hz) are linearly resampled to 24kHz, continuously
+    across chunks. Utterances of different queries (`msg_id`) can
+    interleave, each one has its own encoder and resampler state. It's
+    discarded at the end of utterance, which is also sent on cancel.
+    """
+
+    def __init__(self, bitrate: int, complexity: int):
+        self._bitrate = bitrate
+        self._complexity = complexity
+        # in the order of the last use, see `MAX_OPEN_STREAMS`
+        self._streams: OrderedDict[str, _OpusStream] = OrderedDict()
+
+    def _get_stream(self, chunk: AudioChunk):
+        stream = self._streams.get(chunk.msg_id)
+        if stream is None or stream.in_rate != chunk.sample_rate:
+            stream = _OpusStream(chunk.sample_rate, self._bitrate, self._complexity)
+            self._streams[chunk.msg_id] = stream
+            while len(self._streams) > MAX_OPEN_STREAMS:
+                self._streams.popitem(last=False)  # end of utterance was lost
+        self._streams.move_to_end(chunk.msg_id)
+        return stream
+
+    def encode(self, chunk: AudioChunk, visemes=False) -> Optional[bytearray]:
+        """
+        Runs on the encoder thread. Returns frame or None if nothing to send yet.
+        `visemes` are computed from the exact samples in the frame, which
+        include the samples carried over from the previous chunk.
+        """
+        with Timer() as timer:
+            stream = self._get_stream(chunk)
+            out_rate = stream.out_rate
+            samples = stream.resample(np.frombuffer(chunk.pcm, dtype="<i2"))
+            samples = np.concatenate((stream.pending, samples))
+            frame_len = out_rate * OPUS_FRAME_MS // 1000
+            if chunk.end_of_utterance and len(samples) % frame_len:
+                padding = frame_len - len(samples) % frame_len
+                samples = np.concatenate((samples, np.zeros(padding, np.int16)))
+            frames_end = len(samples) - len(samples) % frame_len
+            stream.pending = samples[frames_end:]
+
+            payload = bytearray()
+            for start in range(0, frames_end, frame_len):
+                frame = samples[start : start + frame_len].tobytes()
+                packet = stream.encoder.encode(frame, frame_len)
+                payload += OPUS_PACKET_LEN.pack(len(packet))
+                payload += packet
+            if chunk.end_of_utterance:
+                del self._streams[chunk.msg_id]
+
+        stats = OPUS_STATS
+        stats.chunks += 1
+        stats.audio_seconds += frames_end / out_rate
+        stats.bytes_in += len(chunk.pcm)
+        stats.bytes_out += len(payload)
+        stats.encode_seconds += timer.delta
+
+        if not payload and not chunk.end_of_utterance:
+            return None
+        viseme_block = None
+        if visemes:
+            from server.visemes import VISEME_FRAME_MS, compute_visemes, encode_visemes
+
+            frame_samples = samples[:frames_end]
+            energy, weights = compute_visemes(frame_samples.tobytes(), out_rate)
+            viseme_block = encode_visemes(energy, weights, VISEME_FRAME_MS)
+        return encode_frame(
+            chunk, payload, FRAME_FORMAT_OPUS, out_rate, visemes=viseme_block
+        )
+
+
+def create_opus_encoder(bitrate: int, complexity: int):
+    if not check_opus():
+        print(
+            colored("Opus is not available.", "red"),
+            "Install 'opuslib' and the native libopus.",
+        )
+        return None
+    return OpusStreamEncoder(bitrate, complexity)
@@ -0,0 +1,177 @@
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Union
+import struct
+
+AUDIO_FORMAT_WAV = "wav"  # legacy. A complete WAV file per chunk
+AUDIO_FORMAT_PCM = "pcm16"  # binary frame with raw int16 PCM
+AUDIO_FORMAT_OPUS = "opus"  # binary frame with Opus packets
+AUDIO_FORMATS = (AUDIO_FORMAT_WAV, AUDIO_FORMAT_PCM, AUDIO_FORMAT_OPUS)
+
+FRAME_MAGIC = b"IRIS"
+FRAME_VERSION = 1
+FRAME_FORMAT_PCM_S16LE = 1
+FRAME_FORMAT_OPUS = 2
+FRAME_FLAG_END_OF_UTTERANCE = 1 << 0
+FRAME_FLAG_VISEMES = 1 << 1  # negotiated with '?visemes=1'
+FRAME_MSG_ID_LEN = 16
+
+# Binary frame, little-endian:
+#   magic         4s  'IRIS'
+#   version       u8
+#   format        u8  FRAME_FORMAT_*
+#   flags         u16 FRAME_FLAG_*
+#   sample_rate   u32
+#   sentence_idx  u16
+#   chunk_seq     u16 chunk index inside the sentence
+#   payload_len   u32 bytes after the header
+#   msg_id        16s utf-8, zero padded
+# followed by the payload:
+#   FRAME_FORMAT_PCM_S16LE - mono int16 PCM
+#   FRAME_FORMAT_OPUS - 20ms mono Opus packets, each prefixed with u16 length
+# If FRAME_FLAG_VISEMES is set, the payload starts with the viseme block
+# (see 'server/visemes.py'), the audio follows:
+#   frame_count   u16
+#   viseme_count  u8
+#   frame_ms      u8
+#   energy        f16[frame_count]
+#   visemes       f16[frame_count][viseme_count]
+FRAME_HEADER = struct.Struct("<4sBBHIHHI16s")
+VISEME_HEADER = struct.Struct("<HBB")
+
+# https://en.wikipedia.org/wiki/WAV#WAV_file_header
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+WAV_STREAM_LEN = 0xFFFFFFFF  # unknown length, the audio is still being generated
+
+Bytes = Union[bytes, bytearray, memoryview]
+
+
+def validate_msg_id(msg_id):
+    """Raises `ValueError` if `msg_id` does not fit into the frame header"""
+    # no value in the message, it's also used as the HTTP reason phrase
+    if not isinstance(msg_id, str) or not msg_id or "\0" in msg_id:
+        raise ValueError("'msgId' has to be a non-empty string")
+    if len(msg_id.encode("utf-8")) > FRAME_MSG_ID_LEN:
+        raise ValueError(f"'msgId' is longer than {FRAME_MSG_ID_LEN} UTF-8 bytes")
+
+
+@dataclass
+class AudioChunk:
+    """Part of the TTS output. Encoded separately for each client's audio format"""
+
+    msg_id: str
+    sentence_idx: int
+    seq: int
+    sample_rate: int
+    pcm: Bytes  # mono int16 little-endian. Empty for end of utterance marker
+    end_of_utterance: bool = False
+    _encoded: Dict[str, Bytes] = field(default_factory=dict, repr=False)
+    _visemes: Optional[Bytes] = field(default=None, repr=False)
+
+    def encode(self, audio_format: str, visemes=False) -> Bytes:
+        """Encode once, even if sent to many clients. Opus is stateful, see `OpusStreamEncoder`"""
+        visemes = visemes and audio_format != AUDIO_FORMAT_WAV
+        key = f"{audio_format}+visemes" if visemes else audio_format
+        data = self._encoded.get(key)
+        if data is None:
+            if audio_format == AUDIO_FORMAT_WAV:
+                data = encode_wav(self.pcm, self.sample_rate)
+            else:
+                viseme_block = self.get_visemes() if visemes else None
+                data = encode_frame(self, visemes=viseme_block)
+            self._encoded[key] = data
+        return data
+
+    def get_visemes(self) -> Bytes:
+        """Encoded viseme block. Computed on first use, shared by all clients"""
+        if self._visemes is None:
+            from server.visemes import VISEME_FRAME_MS, compute_visemes, encode_visemes
+
+            energy, visemes = compute_visemes(self.pcm, self.sample_rate)
+            self._visemes = encode_visemes(energy, visemes, VISEME_FRAME_MS)
+        return self._visemes
+
+
+def encode_frame(
+    chunk: AudioChunk,
+    payload: Optional[Bytes] = None,
+    format=FRAME_FORMAT_PCM_S16LE,
+    sample_rate: Optional[int] = None,
+    visemes: Optional[Bytes] = None,
+):
+    payload = chunk.pcm if payload is None else payload
+    flags = FRAME_FLAG_END_OF_UTTERANCE if chunk.end_of_utterance else 0
+    if visemes is not None:
+        flags |= FRAME_FLAG_VISEMES
+    else:
+        visemes = b""
+    # never truncated, clients match the frames by the full 'msgId'
+    validate_msg_id(chunk.msg_id)
+    msg_id = chunk.msg_id.encode("utf-8")
+
+    # single allocation, PCM is copied straight from the numpy buffer
+    payload_len = len(visemes) + len(payload)
+    out = bytearray(FRAME_HEADER.size + payload_len)
+    FRAME_HEADER.pack_into(
+        out,
+        0,
+        FRAME_MAGIC,
+        FRAME_VERSION,
+        format,
+        flags,
+        sample_rate or chunk.sample_rate,
+        chunk.sentence_idx & 0xFFFF,
+        chunk.seq & 0xFFFF,
+        payload_len,
+        msg_id,
+    )
+    audio_start = FRAME_HEADER.size + len(visemes)
+    out[FRAME_HEADER.size : audio_start] = visemes
+    out[audio_start:] = payload
+    return out
+
+
+def decode_frame_header(data: Bytes):
+    """Returns dict with the header fields. Payload starts at `FRAME_HEADER.size`"""
+    fields = FRAME_HEADER.unpack_from(data, 0)
+    magic, version, format, flags, sample_rate, sentence_idx, seq, size, msg_id = fields
+    if magic != FRAME_MAGIC:
+        raise Exception(f"Invalid audio frame magic: {magic!r}")
+    return {
+        "version": version,
+        "format": format,
+        "end_of_utterance": bool(flags & FRAME_FLAG_END_OF_UTTERANCE),
+        "visemes": bool(flags & FRAME_FLAG_VISEMES),
+        "sample_rate": sample_rate,
+        "sentence_idx": sentence_idx,
+        "seq": seq,
+        "payload_len": size,
+        "msg_id": msg_id.rstrip(b"\0").decode("utf-8"),
+    }
+
+
+def encode_wav(pcm: Bytes, sample_rate: int):
+    """Mono int16 WAV file, same as `scipy.io.wavfile.write()`"""
+    out = bytearray(WAV_HEADER.size + len(pcm))
+    out[: WAV_HEADER.size] = encode_wav_header(sample_rate, len(pcm))
+    out[WAV_HEADER.size :] = pcm
+    return out
+
+
+def encode_wav_header(sample_rate: int, data_len: int = WAV_STREAM_LEN):
+    """Default `data_len` is for streaming, when the length is not known yet"""
+    channels, bytes_per_sample = 1, 2
+    return WAV_HEADER.pack(
+        b"RIFF",
+        min(WAV_HEADER.size - 8 + data_len, WAV_STREAM_LEN),
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        channels,
+        sample_rate,
+        sample_rate * channels * bytes_per_sample,  # byte rate
+        channels * bytes_per_sample,  # block align
+        8 * bytes_per_sample,
+        b"data",
+        data_len,
+    )
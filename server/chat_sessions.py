@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from termcolor import colored
+from typing import Any, Callable, Optional
+import time
+
+from server.config import SessionCfg
+
+
+class ChatSession:
+    """Conversation state of a single client (browser tab, Unity, HTTP caller)"""
+
+    def __init__(self, session_id: Optional[str], chat_context: Any):
+        self.id = session_id
+        self.chat_context = chat_context
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def memory_usage(self) -> int:
+        """Approximate size in bytes"""
+        return self.chat_context.memory_usage()
+
+    def __repr__(self):
+        return f"<ChatSession(id={self.id!r})>"
+
+
+class ChatSessionStore:
+    """
+    Sessions keyed by connection or by client-provided session id.
+    Evicts sessions that are:
+    - idle for more than `idle_ttl` seconds,
+    - least recently used, if there are more than `max_sessions`,
+    - least recently used, if all histories take more than `max_memory_kb`.
+    """
+
+    def __init__(self, cfg: SessionCfg, create_context: Callable[[], Any]):
+        self.cfg = cfg
+        self._create_context = create_context
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id: Optional[str]) -> ChatSession:
+        """
+        Get or create the session. If `session_id` is None, returns
+        a new session that is not stored (e.g. a one-off HTTP request).
+        """
+        if session_id is None:
+            return ChatSession(None, self._create_context())
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = ChatSession(session_id, self._create_context())
+            self._sessions[session_id] = session
+        session.touch()
+        self._sessions.move_to_end(session_id)
+        self.evict(keep=session_id)
+        return session
+
+    def remove(self, session_id: Optional[str]):
+        if session_id is not None:
+            self._sessions.pop(session_id, None)
+
+    def evict(self, keep: Optional[str] = None):
+        # idle sessions. OrderedDict is sorted by last use, oldest first
+        deadline = time.monotonic() - self.cfg.idle_ttl
+        for session_id, session in list(self._sessions.items()):
+            if session.last_used >= deadline:
+                break
+            if session_id != keep:
+                self._remove_evicted(session_id, "idle")
+
+        # too many sessions
+        while len(self._sessions) > self.cfg.max_sessions:
+            if not self._evict_lru(keep, "max_sessions"):
+                break
+
+        # too much memory
+        max_bytes = self.cfg.max_memory_kb * 1024
+        memory = sum(s.memory_usage() for s in self._sessions.values())
+        while memory > max_bytes:
+            session = self._evict_lru(keep, "max_memory_kb")
+            if session is None:
+                break
+            memory -= session.memory_usage()
+
+    def _evict_lru(self, keep: Optional[str], reason: str):
+        for session_id in self._sessions:
+            if session_id != keep:
+                return self._remove_evicted(session_id, reason)
+        return None
+
+    def _remove_evicted(self, session_id: str, reason: str):
+        print(colored("Evicted chat session:", "yellow"), f"{session_id} ({reason})")
+        return self._sessions.pop(session_id)
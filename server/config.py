@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional, Union
 from yaml import load, Loader
 from pydantic import BaseModel, PositiveInt, NonNegativeInt, PositiveFloat, StrictBool
 from termcolor import colored
@@ -11,8 +11,24 @@ class LlmCfg(BaseModel):
     top_k: PositiveInt = 40
     top_p: PositiveFloat = 0.9
     context_length: NonNegativeInt = 10
+    context_tokens: NonNegativeInt = 1536
+    reuse_context: StrictBool = True
     system_message: Optional[str] = None
     api: str = "http://localhost:11434"
+    keep_alive: Optional[Union[str, int]] = None  # None - Ollama's default
+
+
+class TtsCacheCfg(BaseModel):
+    enabled: StrictBool = True
+    memory_mb: NonNegativeInt = 64
+    disk_dir: Optional[str] = None
+
+
+class TtsCpuCfg(BaseModel):
+    quantize: StrictBool = False
+    intra_op_threads: NonNegativeInt = 0  # 0 - torch default
+    inter_op_threads: NonNegativeInt = 0
+    benchmark: StrictBool = False
 
 
 class TtsCfg(BaseModel):
@@ -21,28 +37,69 @@ class TtsCfg(BaseModel):
     model_name: str = "tts_models/en/ljspeech/tacotron2-DDC"
     # vocoder_name: str = "vocoder_models/en/ljspeech/hifigan_v2"
     use_gpu: StrictBool = True
+    inference_mode: StrictBool = True
     chunk_size: NonNegativeInt = 0
     speaker: Optional[str] = None
     language: Optional[str] = None
     sample_of_cloned_voice_wav: Optional[str] = None
+    speaker_latents_file: Optional[str] = None
+    backend: Literal["torch", "onnx"] = "torch"
+    onnx_dir: str = "onnx_cache"
     deepspeed_enabled: StrictBool = True
+    prepared_dir: Optional[str] = "prepared_models"
     streaming_enabled: StrictBool = False
     streaming_chunk_size: PositiveInt = 20  # XTTS default: 20
     streaming_overlap_wav_len: PositiveInt = 1024  # XTTS default: 1024
+    streaming_adaptive: StrictBool = False
+    streaming_min_chunk_size: PositiveInt = 8
+    streaming_max_chunk_size: PositiveInt = 60
+    streaming_target_rtf: PositiveFloat = 0.7
+    workers: PositiveInt = 1
+    queue_size: PositiveInt = 4
+    processes: NonNegativeInt = 0
+    process_threads: NonNegativeInt = 0
+    process_ring_mb: PositiveInt = 4
+    cache: TtsCacheCfg = TtsCacheCfg()
+    cpu: TtsCpuCfg = TtsCpuCfg()
+
+
+class SessionCfg(BaseModel):
+    idle_ttl: PositiveFloat = 30 * 60  # seconds
+    max_sessions: PositiveInt = 100
+    max_memory_kb: PositiveInt = 16 * 1024
 
 
 class ServerCfg(BaseModel):
     host: str = "localhost"
     port: PositiveInt = 8080
+    opus_bitrate: PositiveInt = 24000
+    opus_complexity: NonNegativeInt = 5
+    send_queue_size: PositiveInt = 32
+    send_overflow: Literal["drop_oldest", "disconnect", "block"] = "drop_oldest"
+
+
+class WarmupCfg(BaseModel):
+    enabled: StrictBool = True
+    llm: StrictBool = True
+    tts: StrictBool = True
+
+
+class TracingCfg(BaseModel):
+    enabled: StrictBool = True
+    max_traces: PositiveInt = 100
+    max_spans_per_trace: PositiveInt = 1000
 
 
 class AppConfig(BaseModel):
     """https://docs.pydantic.dev/latest/api/types/"""
 
-    # verbose: StrictBool = False
+    verbose: StrictBool = False
     llm: LlmCfg = LlmCfg()
     tts: TtsCfg = TtsCfg()
+    session: SessionCfg = SessionCfg()
     server: ServerCfg = ServerCfg()
+    tracing: TracingCfg = TracingCfg()
+    warmup: WarmupCfg = WarmupCfg()
 
 
 def load_app_config(filepath=None) -> AppConfig:
@@ -0,0 +1,53 @@
+from typing import Any, List, Optional
+import asyncio
+
+from server.audio_framing import AudioChunk
+from server.json_message import JsonMessage
+from server.signal import Signal
+
+# Sent while waiting for the next event, also detects disconnected clients
+SSE_KEEPALIVE = b": keep-alive\n\n"
+KEEPALIVE_SECONDS = 2.0
+
+
+def sse_event(msg: JsonMessage):
+    """https://html.spec.whatwg.org/multipage/server-sent-events.html"""
+    return f"event: {msg.type}\ndata: {msg.encode()}\n\n".encode("utf-8")
+
+
+class MsgEvents:
+    """
+    AppLogic events of a single query, for the HTTP streaming endpoints.
+    Subscribes to the `signals` and keeps only the messages (`JsonMessage`
+    or `AudioChunk`) for `msg_id`. Call `close()` to unsubscribe.
+    """
+
+    def __init__(self, msg_id: str, signals: List[Signal]):
+        self.msg_id = msg_id
+        self._signals = signals
+        self._queue: asyncio.Queue = asyncio.Queue()
+        for signal in signals:
+            signal.append(self._on_event)
+
+    async def _on_event(self, msg):
+        if isinstance(msg, AudioChunk):
+            msg_id = msg.msg_id
+        else:
+            msg_id = msg.data.get("msgId")
+        if msg_id == self.msg_id:
+            self._queue.put_nowait(msg)
+
+    def put(self, item: Any):
+        """e.g. the finished query task"""
+        self._queue.put_nowait(item)
+
+    async def get(self, timeout: float) -> Optional[Any]:
+        """Returns None on timeout"""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        for signal in self._signals:
+            signal.safe_remove(self._on_event)
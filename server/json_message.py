@@ -0,0 +1,52 @@
+from typing import Any, Dict, Optional
+import json
+
+
+def check_orjson():
+    orjson_available = False
+    try:
+        import orjson
+
+        orjson_available = True
+    except ImportError:
+        pass
+    return orjson_available
+
+
+if check_orjson():
+    import orjson
+
+    def json_dumps(data: Any) -> str:
+        # ~10x faster than json.dumps(). Returns utf-8 bytes
+        return orjson.dumps(data).decode("utf-8")
+
+else:
+
+    def json_dumps(data: Any) -> str:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class JsonMessage:
+    """
+    JSON message for the websocket clients. Encoded once, on first
+    send, no matter how many clients receive it. Use `orjson` (optional,
+    `pip install orjson`) for faster encoding.
+    """
+
+    __slots__ = ("data", "_encoded")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self._encoded: Optional[str] = None
+
+    @property
+    def type(self) -> str:
+        return self.data.get("type", "")
+
+    def encode(self) -> str:
+        if self._encoded is None:
+            self._encoded = json_dumps(self.data)
+        return self._encoded
+
+    def __repr__(self):
+        return f"JsonMessage({self.data!r})"
@@ -0,0 +1,157 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Prometheus text exposition format, without the 'prometheus_client' dependency.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Metrics are updated on the event loop thread only (no locks needed),
+# each update is a few integer additions.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+RTF_BUCKETS = (0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]):
+    if not labels:
+        return ""
+    escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    items = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+    return "{" + items + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally with a single label"""
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self._label = label
+        self._values: Dict[str, float] = {}
+
+    def inc(self, amount: float = 1, label_value: str = ""):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = self._values
+        if not values and not self._label:
+            values = {"": 0}
+        for label_value, value in values.items():
+            labels = [(self._label, label_value)] if self._label else []
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """Current value, read from the callback on each scrape"""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self._read = read
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(self._read())}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self._buckets = tuple(sorted(buckets))
+        # non-cumulative, last one is '+Inf'
+        self._counts: List[int] = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for le, count in zip(self._buckets + (float("inf"),), self._counts):
+            cumulative += count
+            labels = _format_labels([("le", _format_value(le))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum {_format_value(self._sum)}")
+        lines.append(f"{self.name}_count {self._count}")
+        return lines
+
+
+class Metrics:
+    """
+    All metrics exposed on `/metrics`. Histograms and counters are
+    updated where the event happens. Gauges (e.g. active websockets)
+    are registered with a callback and read only when scraped.
+    """
+
+    def __init__(self):
+        self.time_to_first_audio = Histogram(
+            "iris_time_to_first_audio_seconds",
+            "Time from the query to the first synthesized audio chunk",
+            LATENCY_BUCKETS,
+        )
+        self.llm_first_token = Histogram(
+            "iris_llm_first_token_seconds",
+            "LLM time to first token",
+            LATENCY_BUCKETS,
+        )
+        self.llm_seconds = Histogram(
+            "iris_llm_seconds",
+            "LLM time to generate the whole response",
+            LATENCY_BUCKETS,
+        )
+        self.tts_sentence_seconds = Histogram(
+            "iris_tts_sentence_seconds",
+            "Time to synthesize a sentence, including the TTS queue wait",
+            LATENCY_BUCKETS,
+        )
+        self.tts_rtf = Histogram(
+            "iris_tts_real_time_factor",
+            "TTS inference time of a sentence divided by its audio duration",
+            RTF_BUCKETS,
+        )
+        self.errors = Counter(
+            "iris_errors_total", "Errors by the place they happened", "kind"
+        )
+        self.audio_bytes_sent = Counter(
+            "iris_audio_bytes_sent_total",
+            "Audio bytes sent to all websocket clients",
+        )
+        self._gauges: Dict[str, Gauge] = {}
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        """Register (or replace) a gauge"""
+        self._gauges[name] = Gauge(name, help, read)
+
+    def render(self):
+        metrics = [
+            self.time_to_first_audio,
+            self.llm_first_token,
+            self.llm_seconds,
+            self.tts_sentence_seconds,
+            self.tts_rtf,
+            self.errors,
+            self.audio_bytes_sent,
+            *self._gauges.values(),
+        ]
+        lines = [line for metric in metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
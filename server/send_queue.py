@@ -0,0 +1,186 @@
+from aiohttp import web, WSCloseCode
+from collections import deque
+from termcolor import colored
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple
+import asyncio
+import itertools
+import time
+import traceback
+
+from server.audio_framing import AudioChunk, Bytes
+from server.config import ServerCfg
+from server.json_message import JsonMessage
+from server.metrics import METRICS
+from server.tracing import Tracer
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # drop the oldest audio chunk
+OVERFLOW_DISCONNECT = "disconnect"  # close the stuck connection
+OVERFLOW_BLOCK = "block"  # wait for the client. Slows down everyone else
+
+EncodeAudioFn = Callable[[AudioChunk], Awaitable[Optional[Bytes]]]
+
+
+class SendQueueStats:
+    """Totals for all connections"""
+
+    def __init__(self):
+        self.dropped_audio_chunks = 0
+        self.overflow_disconnects = 0
+        self.blocked_puts = 0
+        self.max_queue_len = 0
+        self.queued = 0  # current, all clients
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+SEND_QUEUE_STATS = SendQueueStats()
+
+_client_ids = itertools.count(1)
+
+
+class ClientSendQueue:
+    """
+    Outbound messages of a single websocket. Producers (signal receivers)
+    only append to the bounded queue, a writer task sends the messages
+    in order. A stalled client does not block the TTS loop or other clients.
+
+    When the queue is full, `server.send_overflow` decides what to do:
+    - `drop_oldest` - drop the oldest queued audio chunk. Client skips
+        ahead and stays real-time. JSON messages and end of utterance
+        markers are never dropped.
+    - `disconnect` - close the connection.
+    - `block` - wait until the writer catches up.
+
+    Audio is encoded in the writer task (see `encode_audio`), so chunks
+    that were dropped are never encoded. Queue wait, encoding and send
+    are traced for each message (`ws.queue_wait`, `ws.encode`, `ws.send`).
+    """
+
+    def __init__(
+        self,
+        ws: web.WebSocketResponse,
+        cfg: ServerCfg,
+        encode_audio: EncodeAudioFn,
+        tracer: Tracer,
+    ):
+        self._ws = ws
+        self._tracer = tracer
+        self.client_id = next(_client_ids)
+        self._max_size = cfg.send_queue_size
+        self._overflow = cfg.send_overflow
+        self._encode_audio = encode_audio
+        # (is_droppable, message, queued_ns)
+        self._items: Deque[Tuple[bool, Any, int]] = deque()
+        self._has_items = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._writer: Optional[asyncio.Task] = None
+        self._close_task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self):
+        if self._writer is None and not self.closed:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    def close(self):
+        self.closed = True
+        SEND_QUEUE_STATS.queued -= len(self._items)
+        self._items.clear()
+        self._has_space.set()  # wake up blocked producers
+        if self._writer is not None:
+            self._writer.cancel()
+
+    async def put_json(self, msg: JsonMessage):
+        await self._put(False, msg)
+
+    async def put_audio(self, chunk: AudioChunk):
+        await self._put(not chunk.end_of_utterance, chunk)
+
+    async def _put(self, is_droppable: bool, item: Any):
+        stats = SEND_QUEUE_STATS
+        while not self.closed and len(self._items) >= self._max_size:
+            if self._overflow == OVERFLOW_BLOCK:
+                stats.blocked_puts += 1
+                self._has_space.clear()
+                await self._has_space.wait()
+            elif self._overflow == OVERFLOW_DISCONNECT:
+                self._disconnect()
+            elif self._drop_oldest():
+                stats.dropped_audio_chunks += 1
+            elif is_droppable:
+                stats.dropped_audio_chunks += 1
+                return
+            else:
+                break  # only control messages queued, keep them
+
+        if self.closed:
+            return
+        self._items.append((is_droppable, item, time.time_ns()))
+        stats.queued += 1
+        stats.max_queue_len = max(stats.max_queue_len, len(self._items))
+        self._has_items.set()
+
+    def _drop_oldest(self):
+        for i, (is_droppable, _, _) in enumerate(self._items):
+            if is_droppable:
+                del self._items[i]
+                SEND_QUEUE_STATS.queued -= 1
+                return True
+        return False
+
+    def _disconnect(self):
+        print(
+            colored("Websocket send queue overflow.", "red"),
+            f"Client did not keep up with {self._max_size} queued messages, disconnecting.",
+        )
+        SEND_QUEUE_STATS.overflow_disconnects += 1
+        METRICS.errors.inc(label_value="send_overflow")
+        self.close()
+        self._close_task = asyncio.create_task(
+            self._ws.close(
+                code=WSCloseCode.TRY_AGAIN_LATER, message=b"Send queue overflow"
+            )
+        )
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._items:
+                self._has_items.clear()
+                await self._has_items.wait()
+                continue
+            _, item, queued_ns = self._items.popleft()
+            SEND_QUEUE_STATS.queued -= 1
+            self._has_space.set()
+
+            try:
+                await self._send(item, queued_ns)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._ws.closed:
+                    return
+                METRICS.errors.inc(label_value="websocket_send")
+                traceback.print_exception(e)
+
+    async def _send(self, item: Any, queued_ns: int):
+        tracer = self._tracer
+        client = self.client_id
+        if isinstance(item, AudioChunk):
+            msg_id = item.msg_id
+            tracer.add_span(msg_id, "ws.queue_wait", queued_ns, client=client)
+            with tracer.span(msg_id, "ws.encode", client=client):
+                data = await self._encode_audio(item)
+            if data is None:
+                return
+            with tracer.span(msg_id, "ws.send", client=client, bytes=len(data)):
+                await self._ws.send_bytes(data)
+            METRICS.audio_bytes_sent.inc(len(data))
+        else:
+            msg_id = item.data.get("msgId")
+            tracer.add_span(msg_id, "ws.queue_wait", queued_ns, client=client)
+            with tracer.span(msg_id, "ws.send", client=client, type=item.type):
+                await self._ws.send_str(item.encode())
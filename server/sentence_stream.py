@@ -0,0 +1,65 @@
+import re
+from typing import Callable, List
+
+from server.utils import Timer
+
+# Cheap pre-check. Only run the (slower) segmenter
+# if the buffer might already contain a sentence boundary.
+SENTENCE_END_RE = re.compile(r"[.!?…。！？][\"'”’)\]]*\s")
+
+
+class SentenceStream:
+    """
+    Incremental sentence detector. Feed it LLM tokens as they arrive
+    and get back each sentence as soon as it's complete.
+
+    Uses the same segmenter as the non-streaming code path
+    (`tts.synthesizer.split_into_sentences`), so the sentences are the same.
+    """
+
+    def __init__(self, split_into_sentences: Callable[[str], List[str]]):
+        self._split = split_into_sentences
+        self._parts: List[str] = []
+        self._pending = ""
+        self.split_seconds = 0.0  # total time spent in the segmenter
+
+    @property
+    def text(self):
+        """Full text received so far"""
+        return "".join(self._parts)
+
+    def push(self, token: str) -> List[str]:
+        """Add token, return sentences that are now complete"""
+        self._parts.append(token)
+        self._pending += token
+        if not SENTENCE_END_RE.search(self._pending):
+            return []
+
+        sentences = self._timed_split(self._pending)
+        if len(sentences) < 2:
+            return []
+
+        # The last sentence might be unfinished. Keep it in the buffer.
+        last = sentences[-1].strip()
+        idx = self._pending.rfind(last) if last else -1
+        self._pending = self._pending[idx:] if idx != -1 else sentences[-1]
+        return _clean(sentences[:-1])
+
+    def flush(self) -> List[str]:
+        """Call when the LLM has finished. Returns remaining sentences"""
+        text = self._pending
+        self._pending = ""
+        if not text.strip():
+            return []
+        return _clean(self._timed_split(text))
+
+    def _timed_split(self, text: str):
+        with Timer() as timer:
+            sentences = self._split(text)
+        self.split_seconds += timer.delta
+        return sentences
+
+
+def _clean(sentences: List[str]):
+    sentences = [s.strip() for s in sentences]
+    return [s for s in sentences if len(s) > 0]
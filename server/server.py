@@ -1,10 +1,27 @@
+import asyncio
 import weakref
 from aiohttp import web, WSMsgType, WSCloseCode
-from typing import Callable
-from server.app_logic import AppLogic
+from typing import Callable, Optional
+from server.app_logic import AppLogic, QueryCancelledError
+from server.audio_encoder import OPUS_STATS
+from server.audio_framing import (
+    AUDIO_FORMAT_PCM,
+    AUDIO_FORMAT_WAV,
+    AUDIO_FORMATS,
+    encode_wav_header,
+    validate_msg_id,
+)
+from server.http_stream import KEEPALIVE_SECONDS, SSE_KEEPALIVE, MsgEvents, sse_event
+from server.json_message import JsonMessage
+from server.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS
+from server.send_queue import SEND_QUEUE_STATS
+from server.utils import generate_id
 from termcolor import colored
 import json
 
+# How long '/tts' waits for the query to start
+TTS_STREAM_WAIT_SECONDS = 30.0
+
 
 # store websockets
 # https://docs.aiohttp.org/en/stable/web_advanced.html#websocket-shutdown
@@ -13,10 +30,57 @@ socket_msg_handler_ctx = web.AppKey("socket_msg_handler_ctx", Callable)  # type:
 app_logic_ctx = web.AppKey("app_logic", AppLogic)  # type: ignore
 
 
-async def status(_request):
+async def status(request):
+    """503 until the warm-up has finished, so load balancers wait for warm instances"""
+    if request.app[app_logic_ctx].warming_up:
+        return web.Response(text="warming", status=503)
     return web.Response(text="OK")
 
 
+async def stats_handler(request):
+    app_logic = request.app[app_logic_ctx]
+    stats = app_logic.stats()
+    stats["opus"] = OPUS_STATS.to_dict()
+    stats["send_queue"] = SEND_QUEUE_STATS.to_dict()
+    return web.json_response(stats)
+
+
+async def metrics_handler(_request):
+    """Prometheus scrape endpoint"""
+    return web.Response(
+        body=METRICS.render().encode("utf-8"),
+        headers={"Content-Type": METRICS_CONTENT_TYPE},
+    )
+
+
+async def traces_handler(request):
+    """
+    Latency spans of the last queries. Query params:
+    - `msgId` - only the given query,
+    - `limit` - only the last N queries,
+    - `format` - 'json' (default) or 'otlp' (OpenTelemetry JSON).
+    """
+    tracer = request.app[app_logic_ctx].tracer
+    msg_id = request.query.get("msgId")
+    fmt = request.query.get("format", "json")
+    try:
+        limit = int(request.query.get("limit", "0"))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="'limit' must be a number")
+
+    if msg_id:
+        trace = tracer.get(msg_id)
+        if trace is None:
+            raise web.HTTPNotFound(reason=f"No trace for msgId '{msg_id}'")
+        if fmt == "otlp":
+            return web.json_response(tracer.to_otlp(msg_ids=[msg_id]))
+        return web.json_response(trace.to_dict())
+
+    if fmt == "otlp":
+        return web.json_response(tracer.to_otlp(limit))
+    return web.json_response(tracer.to_json(limit))
+
+
 def is_unity_websocket(request):
     for k, _ in request.raw_headers:
         if k == b"Cache-Control":
@@ -24,6 +88,30 @@ def is_unity_websocket(request):
     return True
 
 
+def get_audio_format(request):
+    """Negotiated on connect e.g. 'ws://localhost:8080/?audio=pcm16'"""
+    audio_format = request.query.get("audio", AUDIO_FORMAT_WAV)
+    if audio_format not in AUDIO_FORMATS:
+        print(
+            colored(f"Unknown audio format '{audio_format}'.", "red"),
+            f"Falling back to '{AUDIO_FORMAT_WAV}'. Available: {AUDIO_FORMATS}",
+        )
+        return AUDIO_FORMAT_WAV
+    return audio_format
+
+
+def get_visemes_flag(request, audio_format: str):
+    """e.g. 'ws://localhost:8080/?audio=pcm16&visemes=1'"""
+    visemes = request.query.get("visemes", "0") in ("1", "true")
+    if visemes and audio_format == AUDIO_FORMAT_WAV:
+        print(
+            colored("Visemes are not sent with WAV audio.", "yellow"),
+            f"Use e.g. '?audio={AUDIO_FORMAT_PCM}&visemes=1'",
+        )
+        return False
+    return visemes
+
+
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
@@ -31,11 +119,18 @@ async def websocket_handler(request):
     request.app[websockets].add(ws)
 
     is_unity = is_unity_websocket(request)
-    handler = request.app[socket_msg_handler_ctx](ws, is_unity)
+    audio_format = get_audio_format(request)
+    visemes = get_visemes_flag(request, audio_format)
+    handler = request.app[socket_msg_handler_ctx](ws, is_unity, audio_format, visemes)
     is_unity_str = "unity" if is_unity else "web_browser"
-    print(colored(f"Websocket connected ({is_unity_str})", "yellow"))
+    visemes_str = " visemes=ON" if visemes else ""
+    print(
+        colored(f"Websocket connected ({is_unity_str})", "yellow"),
+        f"audio={audio_format}{visemes_str}",
+    )
 
     try:
+        await handler.on_connect()
         async for msg in ws:
             # print("RAW MSG:", msg)
             if msg.type == WSMsgType.TEXT:
@@ -56,7 +151,8 @@ async def index_handler(_request):
     raise web.HTTPFound(location="/index.html")
 
 
-async def prompt_handler(request):
+async def get_prompt_params(request):
+    """Returns (prompt, session_id, msg_id). Raises 'HTTPBadRequest' if invalid"""
     is_post = request.method == "POST"
 
     if is_post:
@@ -64,37 +160,236 @@ async def prompt_handler(request):
         for k, v in data.items():
             print(f"'{k}'='{v}'")
         print(f"total={len(data)}")
-        prompt = data.get("value", "")
     else:
-        prompt = request.query.get("value", "")
+        data = request.query
+    prompt = data.get("value", "")
+    session_id = data.get("sessionId")
+    msg_id = data.get("msgId")
 
+    reason = None
     if not prompt:
         field_type = "field" if is_post else "query param"
         reason = f"The {request.method} request is missing 'value' {field_type}."
+    elif msg_id is not None:
+        try:
+            validate_msg_id(msg_id)
+        except ValueError as e:
+            reason = str(e)
+    if reason is not None:
         res = json.dumps({"status": "error", "reason": reason})
-        return web.HTTPBadRequest(text=res, reason=reason)
+        raise web.HTTPBadRequest(text=res, reason=reason)
+    return prompt, session_id, msg_id
+
+
+async def prompt_handler(request):
+    try:
+        prompt, session_id, msg_id = await get_prompt_params(request)
+    except web.HTTPBadRequest as e:
+        return e
     # print(f'prompt="{prompt}"')
 
     app_logic = request.app[app_logic_ctx]
-    llm_text = await app_logic.ask_query(prompt)
+    try:
+        llm_text = await app_logic.ask_query(prompt, msg_id, session_id)
+    except QueryCancelledError:  # newer query with the same 'sessionId'
+        return web.json_response({"status": "cancelled", "received_prompt": prompt})
     res = {"status": "ok", "received_prompt": prompt, "resp": llm_text}
     return web.json_response(res)
 
 
+async def prompt_stream_handler(request):
+    """
+    Same as `/prompt`, but returns Server-Sent Events as the response
+    is generated: 'query', 'text-delta' (LLM tokens), 'done' (full text),
+    'tts-first-chunk', 'tts-elapsed', 'cancelled' (e.g. by a newer query
+    with the same 'sessionId') or 'error'. The query is cancelled if
+    the client disconnects. Use `/tts?msgId=` for the audio.
+    """
+    prompt, session_id, msg_id = await get_prompt_params(request)
+    msg_id = msg_id or generate_id()
+    app_logic: AppLogic = request.app[app_logic_ctx]
+    events = MsgEvents(
+        msg_id,
+        [
+            app_logic.on_query,
+            app_logic.on_text_token,
+            app_logic.on_text_response,
+            app_logic.on_tts_first_chunk,
+            app_logic.on_tts_timings,
+        ],
+    )
+
+    resp = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Msg-Id": msg_id,
+        }
+    )
+    await resp.prepare(request)
+    query_task = asyncio.create_task(app_logic.ask_query(prompt, msg_id, session_id))
+    query_task.add_done_callback(events.put)
+    finished = False
+    try:
+        # both are always sent, 'tts-elapsed' is the last one
+        pending = {"done", "tts-elapsed"}
+        while pending:
+            item = await events.get(KEEPALIVE_SECONDS)
+            if item is None:
+                if query_task.done() and not app_logic.is_running(msg_id):
+                    # TTS was cancelled (newer query, reset) or failed after 'done'
+                    data = {"type": "cancelled", "msgId": msg_id}
+                    await resp.write(sse_event(JsonMessage(data)))
+                    break
+                await resp.write(SSE_KEEPALIVE)
+            elif isinstance(item, asyncio.Task):
+                error = None if item.cancelled() else item.exception()
+                if item.cancelled() or isinstance(error, QueryCancelledError):
+                    data = {"type": "cancelled", "msgId": msg_id}
+                    await resp.write(sse_event(JsonMessage(data)))
+                    break
+                if error is not None:
+                    data = {"type": "error", "msgId": msg_id, "error": str(error)}
+                    await resp.write(sse_event(JsonMessage(data)))
+                    break
+            else:
+                pending.discard(item.type)
+                await resp.write(sse_event(item))
+        finished = True
+    except ConnectionResetError:
+        print(colored("SSE client disconnected:", "yellow"), f"msg_id={msg_id}")
+        return resp
+    finally:
+        events.close()
+        if not finished:
+            query_task.cancel()
+            app_logic.cancel(msg_id)  # TTS can still be running
+
+    await resp.write_eof()
+    return resp
+
+
+async def tts_stream_handler(request):
+    """
+    Audio of the query with `msgId`, as it's generated. Open before sending
+    the query, chunks generated before this request are not sent.
+    `format` is either 'wav' (default, a single WAV with unknown length)
+    or 'pcm16' (binary frames, same as the websocket). The query is
+    cancelled if the client disconnects. 410 if the query was cancelled
+    before its first chunk.
+    """
+    msg_id = request.query.get("msgId")
+    audio_format = request.query.get("format", AUDIO_FORMAT_WAV)
+    if not msg_id:
+        raise web.HTTPBadRequest(reason="Missing 'msgId' query param")
+    try:
+        validate_msg_id(msg_id)
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+    if audio_format not in (AUDIO_FORMAT_WAV, AUDIO_FORMAT_PCM):
+        reason = f"Unsupported format '{audio_format}', use 'wav' or 'pcm16'"
+        raise web.HTTPBadRequest(reason=reason)
+
+    app_logic: AppLogic = request.app[app_logic_ctx]
+    # 'query' tells that it has started, so it can't be mistaken for a late query
+    events = MsgEvents(msg_id, [app_logic.on_query, app_logic.on_tts_response])
+    content_type = "audio/wav" if audio_format == AUDIO_FORMAT_WAV else None
+    resp = web.StreamResponse(
+        headers={"Content-Type": content_type or "application/octet-stream"}
+    )
+    waited = 0.0
+    started = False
+    finished = False
+    try:
+        while True:
+            chunk = await events.get(KEEPALIVE_SECONDS)
+            if chunk is None:
+                if request.transport is None or request.transport.is_closing():
+                    raise ConnectionResetError()
+                if resp.prepared:
+                    if not app_logic.is_running(msg_id):
+                        break  # e.g. cancelled by a newer query
+                    continue
+
+                if started and not app_logic.is_running(msg_id):
+                    # cancelled (newer query, reset) before the first chunk
+                    raise web.HTTPGone(reason=f"Query '{msg_id}' was cancelled")
+                if not app_logic.is_running(msg_id):
+                    waited += KEEPALIVE_SECONDS
+                if waited >= TTS_STREAM_WAIT_SECONDS:
+                    raise web.HTTPNotFound(reason=f"Query '{msg_id}' did not start")
+                continue
+            if isinstance(chunk, JsonMessage):
+                started = True  # the 'query' event
+                continue
+            if chunk.end_of_utterance and not resp.prepared:
+                # cancelled queries also end the utterance, but are no longer running
+                if not app_logic.is_running(msg_id):
+                    raise web.HTTPGone(reason=f"Query '{msg_id}' was cancelled")
+
+            if not resp.prepared:
+                await resp.prepare(request)
+                if audio_format == AUDIO_FORMAT_WAV:
+                    await resp.write(encode_wav_header(chunk.sample_rate))
+
+            if audio_format == AUDIO_FORMAT_WAV:
+                await resp.write(chunk.pcm)
+            else:
+                await resp.write(chunk.encode(audio_format))
+            if chunk.end_of_utterance:
+                break
+        finished = True
+    except ConnectionResetError:
+        print(colored("Audio client disconnected:", "yellow"), f"msg_id={msg_id}")
+        return resp
+    finally:
+        events.close()
+        if not finished:
+            app_logic.cancel(msg_id)
+
+    await resp.write_eof()
+    return resp
+
+
 async def on_shutdown(app):
     for ws in set(app[websockets]):
         await ws.close(code=WSCloseCode.GOING_AWAY, message="Server shutdown")
 
 
-def create_server(static_dir, ws_handler, app_logic):
+async def on_cleanup(app):
+    app[app_logic_ctx].shutdown()  # e.g. stop TTS worker processes
+
+
+def create_server(
+    static_dir, ws_handler, app_logic, warm_up_text: Optional[str] = None
+):
+    """Runs `app_logic.warm_up()` on startup if `warm_up_text` is set"""
     app = web.Application()
     app[socket_msg_handler_ctx] = ws_handler
     app[app_logic_ctx] = app_logic
 
     app[websockets] = weakref.WeakSet()
+    METRICS.gauge(
+        "iris_websockets", "Connected websocket clients", lambda: len(app[websockets])
+    )
+    METRICS.gauge(
+        "iris_send_queue_depth",
+        "Messages queued for all websocket clients",
+        lambda: SEND_QUEUE_STATS.queued,
+    )
     app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    if warm_up_text is not None:
+
+        async def start_warm_up(app):
+            app[app_logic_ctx].start_warm_up(warm_up_text)
+
+        app.on_startup.append(start_warm_up)
 
     app.add_routes([web.get("/status", status)])
+    app.add_routes([web.get("/stats", stats_handler)])
+    app.add_routes([web.get("/traces", traces_handler)])
+    app.add_routes([web.get("/metrics", metrics_handler)])
     app.add_routes(
         [web.get("/", websocket_handler)]
     )  # unity might have problem otherwise?
@@ -102,6 +397,13 @@ def create_server(static_dir, ws_handler, app_logic):
     app.add_routes(
         [web.get("/prompt", prompt_handler), web.post("/prompt", prompt_handler)]
     )
+    app.add_routes(
+        [
+            web.get("/prompt/stream", prompt_stream_handler),
+            web.post("/prompt/stream", prompt_stream_handler),
+        ]
+    )
+    app.add_routes([web.get("/tts", tts_stream_handler)])
 
     # bleh, bleh, development only (aiohttp docs mumbling continues..)
     app.add_routes([web.static("/", static_dir)])
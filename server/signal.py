@@ -1,3 +1,4 @@
+import asyncio
 import types
 from collections.abc import MutableSequence
 
@@ -6,19 +7,25 @@ class Signal(MutableSequence):
     """
     Tiny pub/sub list implementation
 
+    With `concurrent=True`, `send()` awaits all receivers at the same time.
+    A slow receiver (e.g. a stalled websocket) does not delay the others.
+    Order is still kept for each receiver, as `send()` returns only after
+    all of them are done.
+
     Partially inspired by:
     - https://github.com/aio-libs/aiosignal/blob/master/aiosignal/__init__.py
     """
 
-    __slots__ = "_items"
+    __slots__ = ("_items", "_concurrent")
     __class_getitem__ = classmethod(types.GenericAlias)
 
-    def __init__(self, items=None):
+    def __init__(self, items=None, concurrent=False):
         if items is not None:
             items = list(items)
         else:
             items = []
         self._items = items
+        self._concurrent = concurrent
 
     def __getitem__(self, index):
         return self._items[index]
@@ -58,5 +65,11 @@ class Signal(MutableSequence):
             self.remove(item)
 
     async def send(self, *args, **kwargs):
+        if self._concurrent and len(self._items) > 1:
+            # copy, receivers may unsubscribe while we wait
+            receivers = [receiver(*args, **kwargs) for receiver in list(self)]
+            await asyncio.gather(*receivers)
+            return
+
         for receiver in self:
             await receiver(*args, **kwargs)  # type: ignore
@@ -1,10 +1,24 @@
 import traceback
+import asyncio
 from aiohttp import web
 
 from termcolor import colored
-from typing import Any
 
-from server.app_logic import AppLogic
+from server.app_logic import AppLogic, QueryCancelledError
+from server.audio_encoder import create_opus_encoder, get_encoder_executor
+from server.audio_framing import (
+    AUDIO_FORMAT_OPUS,
+    AUDIO_FORMAT_PCM,
+    AUDIO_FORMAT_WAV,
+    FRAME_VERSION,
+    AudioChunk,
+    validate_msg_id,
+)
+from server.json_message import JsonMessage
+from server.metrics import METRICS
+from server.send_queue import ClientSendQueue
+from server.visemes import VISEME_NAMES
+from server.utils import generate_id
 
 
 class SocketMsgHandler:
@@ -13,10 +27,32 @@ class SocketMsgHandler:
         ws: web.WebSocketResponse,
         app_logic: AppLogic,
         is_unity: bool,
+        audio_format: str = AUDIO_FORMAT_WAV,
+        visemes=False,
     ):
         self.ws = ws
         self.app_logic = app_logic
         self.is_unity = is_unity
+        self.audio_format = audio_format
+        self._opus = None
+        if audio_format == AUDIO_FORMAT_OPUS:
+            server_cfg = app_logic.cfg.server
+            self._opus = create_opus_encoder(
+                server_cfg.opus_bitrate, server_cfg.opus_complexity
+            )
+            if self._opus is None:
+                self.audio_format = AUDIO_FORMAT_PCM
+        # energy and viseme weights in each binary frame, see `server/visemes.py`
+        self.visemes = visemes and self.audio_format != AUDIO_FORMAT_WAV
+        # chat history of this connection, unless the client sends 'sessionId'
+        self.session_id = generate_id()
+        # queries started from this connection, cancelled on disconnect
+        self._msg_ids = set()
+        self._query_tasks = set()
+        # all messages go through the queue, see `ClientSendQueue`
+        self._send_queue = ClientSendQueue(
+            ws, app_logic.cfg.server, self._encode_audio, app_logic.tracer
+        )
 
         if self.is_unity:
             # app_logic.on_text_response.append(self.on_text_response)
@@ -30,6 +66,10 @@ class SocketMsgHandler:
             app_logic.on_tts_first_chunk.append(self.on_tts_first_chunk)
 
     def on_disconnect(self):
+        self._send_queue.close()
+        for msg_id in self._msg_ids:
+            self.app_logic.cancel(msg_id)
+        self.app_logic.close_session(self.session_id)
         self.app_logic.on_query.safe_remove(self.on_query)
         self.app_logic.on_text_response.safe_remove(self.on_text_response)
         self.app_logic.on_tts_response.safe_remove(self.on_tts_response)
@@ -40,17 +80,19 @@ class SocketMsgHandler:
     async def __call__(self, msg):
         # print(msg)
         type = msg.get("type", "")
+        msg_id = msg.get("msgId") or generate_id()
+        session_id = msg.get("sessionId") or self.session_id
 
         try:
             if type == "query":
-                msg_id = msg.get("msgId", "")
+                validate_msg_id(msg_id)  # sent back in each audio frame
                 text = msg.get("text", "")
-                await self.app_logic.ask_query(text, msg_id)
+                self._start_query(text, msg_id, session_id)
             elif type == "play-vfx":
                 vfx = msg.get("vfx", "")
                 await self.app_logic.play_vfx(vfx)
             elif type == "reset-context":
-                self.app_logic.reset_context()
+                self.app_logic.reset_context(session_id)
             else:
                 print(
                     colored(f'[Socket error] Unrecognised message: "{type}"', "red"),
@@ -58,61 +100,94 @@ class SocketMsgHandler:
                 )
 
         except Exception as e:
-            traceback.print_exception(e)
-            data = {
-                "type": "error",
-                "msgId": msg_id,
-                "error": str(e),
-            }
-            await self.ws_send_json(data)
+            METRICS.errors.inc(label_value="message")
+            await self._send_error(msg_id, e)
+
+    def _start_query(self, text: str, msg_id: str, session_id: str):
+        """
+        Run in a separate task, so that we can still receive messages
+        (e.g. a new query that cancels this one) during LLM generation.
+        """
+        self._msg_ids = {id for id in self._msg_ids if self.app_logic.is_running(id)}
+        self._msg_ids.add(msg_id)
+
+        task = asyncio.create_task(self._ask_query(text, msg_id, session_id))
+        self._query_tasks.add(task)
+        task.add_done_callback(self._query_tasks.discard)
+
+    async def _ask_query(self, text: str, msg_id: str, session_id: str):
+        try:
+            await self.app_logic.ask_query(text, msg_id, session_id)
+        except QueryCancelledError:
+            # barge-in (newer query), context reset etc. Not an error
+            await self._send_cancelled(msg_id)
+        except Exception as e:
+            METRICS.errors.inc(label_value="query")
+            await self._send_error(msg_id, e)
 
-    async def on_query(self, msg: str, msg_id: str):
-        data = {
-            "type": "query",
-            "msgId": msg_id,
-            "text": msg,
-        }
-        await self.ws_send_json(data)
+    async def _send_cancelled(self, msg_id: str):
+        data = {"type": "cancelled", "msgId": msg_id}
+        if not self.ws.closed:
+            await self.ws_send_json(JsonMessage(data))
 
-    async def on_text_response(self, msg: str, msg_id: str, elapsed_llm: float):
+    async def _send_error(self, msg_id: str, e: Exception):
+        traceback.print_exception(e)
         data = {
-            "type": "done",
+            "type": "error",
             "msgId": msg_id,
-            "text": msg,
-            "elapsed_llm": elapsed_llm,
+            "error": str(e),
         }
-        print(data)
-        await self.ws_send_json(data)
+        if not self.ws.closed:
+            await self.ws_send_json(JsonMessage(data))
 
-    async def on_tts_response(self, bytes):
-        # print("on_tts_response()")
-        await self.ws_send_bytes(bytes)
-
-    async def on_tts_first_chunk(self, msg_id: str, elapsed_tts: float):
-        data = {
-            "type": "tts-first-chunk",
-            "msgId": msg_id,
-            "first_chunk_tts": elapsed_tts,
-        }
-        await self.ws_send_json(data)
+    # AppLogic events are already encoded once for all clients, see `JsonMessage`
 
-    async def on_tts_timinigs(self, msg_id: str, elapsed_tts: float):
-        data = {
-            "type": "tts-elapsed",
-            "msgId": msg_id,
-            "elapsed_tts": elapsed_tts,
-        }
-        await self.ws_send_json(data)
+    async def on_query(self, msg: JsonMessage):
+        await self.ws_send_json(msg)
 
-    async def on_play_vfx(self, vfx: str):
-        data = {
-            "type": "play-vfx",
-            "vfx": vfx,
-        }
-        await self.ws_send_json(data)
+    async def on_text_response(self, msg: JsonMessage):
+        await self.ws_send_json(msg)
 
-    async def ws_send_json(self, data: Any):
-        await self.ws.send_json((data))
+    async def on_connect(self):
+        self._send_queue.start()
+        if self.audio_format != AUDIO_FORMAT_WAV:
+            # confirm the negotiated format. Legacy WAV clients get nothing
+            data = {
+                "type": "audio-format",
+                "format": self.audio_format,
+                "version": FRAME_VERSION,
+            }
+            if self.visemes:
+                data["visemes"] = list(VISEME_NAMES)
+            await self.ws_send_json(JsonMessage(data))
 
-    async def ws_send_bytes(self, data: Any):
-        await self.ws.send_bytes(data)
+    async def on_tts_response(self, chunk: AudioChunk):
+        # print("on_tts_response()")
+        if self.audio_format == AUDIO_FORMAT_WAV and chunk.end_of_utterance:
+            return  # legacy clients only get the audio
+        await self._send_queue.put_audio(chunk)
+
+    async def _encode_audio(self, chunk: AudioChunk):
+        """Called by the send queue's writer task, right before sending"""
+        if self._opus is None:
+            return chunk.encode(self.audio_format, self.visemes)
+
+        # stateful encoder, different output for each client. Also computes
+        # the visemes, the frame's audio is not the same as `chunk.pcm`
+        loop = asyncio.get_running_loop()
+        executor = get_encoder_executor()
+        return await loop.run_in_executor(
+            executor, self._opus.encode, chunk, self.visemes
+        )
+
+    async def on_tts_first_chunk(self, msg: JsonMessage):
+        await self.ws_send_json(msg)
+
+    async def on_tts_timinigs(self, msg: JsonMessage):
+        await self.ws_send_json(msg)
+
+    async def on_play_vfx(self, msg: JsonMessage):
+        await self.ws_send_json(msg)
+
+    async def ws_send_json(self, msg: JsonMessage):
+        await self._send_queue.put_json(msg)
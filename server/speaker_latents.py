@@ -0,0 +1,117 @@
+from termcolor import colored
+from typing import Dict, Iterable, Optional, Tuple
+import os.path
+import threading
+import torch
+
+from server.tts_cache import hash_file
+
+LATENT_NAMES = ("gpt_cond_latent", "speaker_embedding")
+
+
+class SpeakerLatentStore:
+    """
+    XTTS conditioning latents (`gpt_cond_latent`, `speaker_embedding`) per voice.
+    The key is either the speaker name, or the hash of the cloned voice file.
+
+    Latents can be precomputed into a single safetensors file
+    (`main.py precompute-speaker-latents`). The file is memory-mapped
+    at startup, each voice is copied to the GPU on first use.
+    Voices missing from the file are computed on demand.
+    """
+
+    def __init__(self, model, filepath: Optional[str] = None):
+        self._model = model
+        self._device_latents: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._voice_keys: Dict[str, str] = {}  # voice file path -> key
+        self._lock = threading.Lock()
+        self._file = None
+        if filepath:
+            self._file = SpeakerLatentStore._open_file(filepath)
+
+    @staticmethod
+    def _open_file(filepath: str):
+        if not os.path.exists(filepath):
+            print(
+                colored("Speaker latents file not found:", "red"),
+                f"'{filepath}'. Run 'main.py precompute-speaker-latents' first.",
+            )
+            return None
+        from safetensors import safe_open
+
+        file = safe_open(filepath, framework="pt", device="cpu")  # mmap
+        voices = {k.rsplit("/", 1)[0] for k in file.keys()}
+        print(
+            colored("Speaker latents file:", "blue"),
+            f"'{filepath}' ({len(voices)} voices)",
+        )
+        return file
+
+    def voice_key(self, speaker_name: Optional[str], voice_file: Optional[str]):
+        if not voice_file:
+            return f"speaker:{speaker_name}"
+        key = self._voice_keys.get(voice_file)
+        if key is None:
+            key = f"voice_sha256:{hash_file(voice_file)}"
+            self._voice_keys[voice_file] = key
+        return key
+
+    def get(self, speaker_name: Optional[str], voice_file: Optional[str] = None):
+        """Returns `(speaker_embedding, gpt_cond_latent)` on model's device"""
+        key = self.voice_key(speaker_name, voice_file)
+        latents = self._device_latents.get(key)
+        if latents is not None:
+            return latents
+
+        with self._lock:
+            latents = self._device_latents.get(key)
+            if latents is not None:
+                return latents
+            gpt_cond_latent, speaker_embedding = self._load(key)
+            if gpt_cond_latent is None:
+                gpt_cond_latent, speaker_embedding = self.compute(
+                    speaker_name, voice_file
+                )
+            device = self._model.device
+            latents = (speaker_embedding.to(device), gpt_cond_latent.to(device))
+            self._device_latents[key] = latents
+        return latents
+
+    def compute(self, speaker_name: Optional[str], voice_file: Optional[str]):
+        """Returns `(gpt_cond_latent, speaker_embedding)`"""
+        if voice_file:
+            print(colored("Voice clonning:", "blue"), f"'{voice_file}'.")
+            return self._model.get_conditioning_latents(audio_path=[voice_file])
+
+        speaker = self._model.speaker_manager.speakers.get(speaker_name)
+        if speaker is None:
+            raise Exception(f"Unknown speaker: '{speaker_name}'")
+        return speaker.get("gpt_cond_latent"), speaker.get("speaker_embedding")
+
+    def _load(self, key: str):
+        if self._file is None:
+            return None, None
+        names = [f"{key}/{name}" for name in LATENT_NAMES]
+        if names[0] not in self._file.keys():
+            return None, None
+        return tuple(self._file.get_tensor(name) for name in names)
+
+    def save(
+        self,
+        filepath: str,
+        speaker_names: Iterable[str],
+        voice_files: Iterable[str] = (),
+    ):
+        """Compute latents for all voices and write them into a single file"""
+        from safetensors.torch import save_file
+        from tqdm import tqdm
+
+        voices = [(name, None) for name in speaker_names]
+        voices += [(None, voice_file) for voice_file in voice_files]
+        tensors = {}
+        for speaker_name, voice_file in tqdm(voices):
+            key = self.voice_key(speaker_name, voice_file)
+            latents = self.compute(speaker_name, voice_file)
+            for name, tensor in zip(LATENT_NAMES, latents):
+                tensors[f"{key}/{name}"] = tensor.detach().cpu().contiguous()
+        save_file(tensors, filepath)
@@ -0,0 +1,221 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+import hashlib
+import threading
+import time
+
+from server.config import TracingCfg
+
+AttrValue = Any  # str, bool, int or float
+OTLP_SERVICE_NAME = "ai-iris-avatar"
+
+
+class Span:
+    __slots__ = ("name", "start_ns", "end_ns", "attributes")
+
+    def __init__(
+        self,
+        name: str,
+        start_ns: int,
+        end_ns: int,
+        attributes: Optional[Dict[str, AttrValue]] = None,
+    ):
+        self.name = name
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.attributes = attributes or {}
+
+    @property
+    def duration(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_dict(self, trace_start_ns: int):
+        return {
+            "name": self.name,
+            "start": (self.start_ns - trace_start_ns) / 1e9,
+            "duration": self.duration,
+            **self.attributes,
+        }
+
+
+class Trace:
+    """All spans of a single query, see `Tracer`"""
+
+    def __init__(self, msg_id: str, attributes: Dict[str, AttrValue]):
+        self.msg_id = msg_id
+        self.root = Span("request", time.time_ns(), 0, attributes)
+        self.spans: List[Span] = []
+        self.dropped_spans = 0
+
+    @property
+    def is_running(self):
+        return self.root.end_ns == 0
+
+    def stages(self):
+        """Total seconds spent in each kind of span"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def to_dict(self):
+        start_ns = self.root.start_ns
+        end_ns = self.root.end_ns or time.time_ns()
+        return {
+            "msgId": self.msg_id,
+            "start": start_ns / 1e9,
+            "duration": (end_ns - start_ns) / 1e9,
+            "running": self.is_running,
+            "attributes": self.root.attributes,
+            "stages": self.stages(),
+            "spans": [span.to_dict(start_ns) for span in self.spans],
+            "dropped_spans": self.dropped_spans,
+        }
+
+
+class Tracer:
+    """
+    Latency spans for each query (`msg_id`): LLM, sentence split, TTS
+    queue wait and synthesis, audio encoding and websocket send. Kept in
+    memory for the last `tracing.max_traces` queries (oldest are dropped).
+    Export with `to_json()` or `to_otlp()` (OpenTelemetry JSON).
+
+    Spans are added after the fact (`add_span()`) or with the `span()`
+    context manager. Safe to call from the TTS worker threads.
+    """
+
+    def __init__(self, cfg: TracingCfg):
+        self.enabled = cfg.enabled
+        self._max_traces = cfg.max_traces
+        self._max_spans = cfg.max_spans_per_trace
+        self._traces: OrderedDict[str, Trace] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_trace(self, msg_id: str, **attributes: AttrValue):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._traces[msg_id] = Trace(msg_id, attributes)
+            self._traces.move_to_end(msg_id)
+            while len(self._traces) > self._max_traces:
+                self._traces.popitem(last=False)
+
+    def end_trace(self, msg_id: str, **attributes: AttrValue):
+        trace = self._traces.get(msg_id)
+        if trace is not None and trace.is_running:
+            trace.root.end_ns = time.time_ns()
+            trace.root.attributes.update(attributes)
+
+    def add_span(
+        self,
+        msg_id: Optional[str],
+        name: str,
+        start_ns: int,
+        end_ns: Optional[int] = None,
+        **attributes: AttrValue,
+    ):
+        """No-op if there is no trace for `msg_id` (e.g. already dropped)"""
+        if not self.enabled or not msg_id:
+            return
+        trace = self._traces.get(msg_id)
+        if trace is None:
+            return
+        span = Span(name, start_ns, end_ns or time.time_ns(), attributes)
+        with self._lock:
+            if len(trace.spans) < self._max_spans:
+                trace.spans.append(span)
+            else:
+                trace.dropped_spans += 1
+
+    @contextmanager
+    def span(self, msg_id: Optional[str], name: str, **attributes: AttrValue):
+        """Yields the attributes dict, add more before the span ends"""
+        start_ns = time.time_ns()
+        try:
+            yield attributes
+        finally:
+            self.add_span(msg_id, name, start_ns, **attributes)
+
+    def get(self, msg_id: str) -> Optional[Trace]:
+        return self._traces.get(msg_id)
+
+    def _last_traces(
+        self, limit: int = 0, msg_ids: Optional[List[str]] = None
+    ) -> List[Trace]:
+        with self._lock:
+            traces = list(self._traces.values())
+        if msg_ids is not None:
+            traces = [trace for trace in traces if trace.msg_id in msg_ids]
+        return traces[-limit:] if limit > 0 else traces
+
+    def to_json(self, limit: int = 0):
+        return {"traces": [trace.to_dict() for trace in self._last_traces(limit)]}
+
+    def to_otlp(self, limit: int = 0, msg_ids: Optional[List[str]] = None):
+        """
+        OTLP/JSON `ExportTraceServiceRequest`. Can be POSTed
+        to an OpenTelemetry collector's `/v1/traces` endpoint.
+        """
+        spans = []
+        for trace in self._last_traces(limit, msg_ids):
+            spans.extend(_trace_to_otlp(trace))
+        resource = {"attributes": [_otlp_attr("service.name", OTLP_SERVICE_NAME)]}
+        scope_spans = {"scope": {"name": "server.tracing"}, "spans": spans}
+        return {"resourceSpans": [{"resource": resource, "scopeSpans": [scope_spans]}]}
+
+
+def _trace_to_otlp(trace: Trace):
+    trace_id = hashlib.md5(trace.msg_id.encode("utf-8")).hexdigest()  # 16 bytes
+    root_id = f"{1:016x}"
+    root = trace.root
+    spans = [
+        _span_to_otlp(
+            trace_id,
+            root_id,
+            None,
+            root,
+            root.end_ns or time.time_ns(),
+            {"msg_id": trace.msg_id, **root.attributes},
+        )
+    ]
+    for i, span in enumerate(trace.spans):
+        span_id = f"{i + 2:016x}"
+        spans.append(
+            _span_to_otlp(
+                trace_id, span_id, root_id, span, span.end_ns, span.attributes
+            )
+        )
+    return spans
+
+
+def _span_to_otlp(
+    trace_id: str,
+    span_id: str,
+    parent_id: Optional[str],
+    span: Span,
+    end_ns: int,
+    attributes: Dict[str, AttrValue],
+):
+    result = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [_otlp_attr(k, v) for k, v in attributes.items()],
+    }
+    if parent_id is not None:
+        result["parentSpanId"] = parent_id
+    return result
+
+
+def _otlp_attr(key: str, value: AttrValue):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from termcolor import colored
+from typing import Optional, Sequence
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+from server.config import AppConfig
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+# disk entry: u32 chunk count, u32 length per chunk, then chunk bytes
+DISK_COUNT = struct.Struct("<I")
+
+
+def hash_file(filepath: str):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def normalize_sentence(sentence: str):
+    # TTS models lowercase the text anyway (XTTS, english_cleaners)
+    return WHITESPACE_RE.sub(" ", sentence).strip().lower()
+
+
+class TtsCache:
+    """
+    PCM audio for each sentence. Key is a hash of: model, backend,
+    quantization, voice (speaker name or hash of the cloned voice file),
+    language, streaming settings and the normalized sentence.
+
+    - memory tier: LRU with byte budget (`tts.cache.memory_mb`),
+    - disk tier (optional, `tts.cache.disk_dir`): a file per sentence,
+        read through `mmap`. Survives server restarts.
+
+    Not thread-safe, use from the event loop. Only `disk_put()`
+    is meant to run on a worker thread.
+    """
+
+    def __init__(self, cfg: AppConfig):
+        self._memory: OrderedDict[str, Sequence[bytes]] = OrderedDict()
+        self._memory_bytes = 0
+        self._max_memory_bytes = cfg.tts.cache.memory_mb * 1024 * 1024
+        self._disk_dir = cfg.tts.cache.disk_dir
+        if self._disk_dir:
+            os.makedirs(self._disk_dir, exist_ok=True)
+        self._key_prefix = TtsCache._create_key_prefix(cfg)
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _create_key_prefix(cfg: AppConfig):
+        tts = cfg.tts
+        voice = f"speaker={tts.speaker}"
+        if tts.sample_of_cloned_voice_wav:
+            voice = f"voice_sha256={hash_file(tts.sample_of_cloned_voice_wav)}"
+        streaming = "off"
+        if tts.streaming_enabled:
+            streaming = f"{tts.streaming_chunk_size}/{tts.streaming_overlap_wav_len}"
+            if tts.streaming_adaptive:
+                min_size = tts.streaming_min_chunk_size
+                chunk_sizes = f"{min_size}-{tts.streaming_max_chunk_size}"
+                streaming = f"adaptive/{chunk_sizes}/{tts.streaming_overlap_wav_len}"
+        # ONNX and int8 quantized models sound slightly different
+        backend = f"{tts.backend}/quantize={tts.cpu.quantize}"
+        streaming = f"streaming={streaming}"
+        return f"pcm16|{tts.model_name}|{backend}|{voice}|{tts.language}|{streaming}|"
+
+    def key(self, sentence: str):
+        text = self._key_prefix + normalize_sentence(sentence)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Sequence[bytes]]:
+        chunks = self._memory.get(key)
+        if chunks is not None:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return chunks
+
+        chunks = self._disk_get(key)
+        if chunks is not None:
+            self.hits_disk += 1
+            self.put(key, chunks)  # keeps the file mapped while in the memory tier
+            return chunks
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, chunks: Sequence[bytes]):
+        """Adds to memory tier. Call `disk_put()` separately"""
+        size = sum(len(c) for c in chunks)
+        if size > self._max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= sum(len(c) for c in old)
+
+        self._memory[key] = chunks
+        self._memory_bytes += size
+        while self._memory_bytes > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= sum(len(c) for c in evicted)
+            self.evictions += 1
+
+    @property
+    def has_disk(self):
+        return bool(self._disk_dir)
+
+    def disk_put(self, key: str, chunks: Sequence[bytes]):
+        """Blocking IO, run on a worker thread"""
+        if not self._disk_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = None
+        try:
+            # unique name, many threads can write the same sentence at once
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self._disk_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(DISK_COUNT.pack(len(chunks)))
+                f.write(struct.pack(f"<{len(chunks)}I", *(len(c) for c in chunks)))
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)  # atomic, readers never see half a file
+        except OSError as e:
+            print(colored("TTS cache write failed:", "red"), e)
+            if tmp_path is not None:
+                TtsCache._remove_file(tmp_path)
+
+    def _disk_get(self, key: str):
+        if not self._disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except ValueError:  # empty file
+            TtsCache._remove_corrupt(path)
+            return None
+
+        # memoryviews keep the mmap alive, no copy until sent to the client
+        view = memoryview(data)
+        lengths = TtsCache._read_lengths(view)
+        if lengths is None:
+            view.release()
+            data.close()  # Windows cannot delete a mapped file
+            TtsCache._remove_corrupt(path)
+            return None
+        offset = DISK_COUNT.size + 4 * len(lengths)
+        chunks = []
+        for length in lengths:
+            chunks.append(view[offset : offset + length])
+            offset += length
+        return chunks
+
+    @staticmethod
+    def _read_lengths(view: memoryview):
+        """Chunk lengths, or None if the file is truncated or corrupt"""
+        try:
+            (count,) = DISK_COUNT.unpack_from(view, 0)
+            offset = DISK_COUNT.size
+            if offset + 4 * count > len(view):
+                return None
+            lengths = struct.unpack_from(f"<{count}I", view, offset)
+        except struct.error:
+            return None
+        if offset + 4 * count + sum(lengths) != len(view):
+            return None
+        return lengths
+
+    @staticmethod
+    def _remove_corrupt(path: str):
+        print(colored("TTS cache: removing corrupt entry", "yellow"), f"'{path}'")
+        TtsCache._remove_file(path)
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _disk_path(self, key: str):
+        return os.path.join(self._disk_dir, f"{key}.bin")  # type: ignore
+
+    def stats(self):
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+        }
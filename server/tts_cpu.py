@@ -0,0 +1,82 @@
+from TTS.api import TTS
+from termcolor import colored
+import torch
+
+from server.config import AppConfig
+from server.utils import Timer
+
+# ~6s of speech. Long enough to hide the per-call overhead
+BENCHMARK_TEXT = (
+    "The current algorithm only upscales the luma, the chroma is preserved as-is."
+    " This is a common trick known to improve the speed."
+)
+
+QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM, torch.nn.LSTMCell}
+
+
+def set_torch_threads(cfg: AppConfig):
+    """Call before the model is loaded. Inter-op threads can only be set once"""
+    cpu_cfg = cfg.tts.cpu
+    if cpu_cfg.intra_op_threads:
+        torch.set_num_threads(cpu_cfg.intra_op_threads)
+    if cpu_cfg.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(cpu_cfg.inter_op_threads)
+        except RuntimeError as e:
+            print(colored("Could not set torch inter-op threads:", "red"), e)
+    print(
+        colored("Torch threads:", "blue"),
+        f"intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}",
+    )
+
+
+def quantize_tts(tts: TTS):
+    """Dynamic int8 quantization of Linear/LSTM/LSTMCell layers. CPU only"""
+    synthesizer = tts.synthesizer
+    for name in ("tts_model", "vocoder_model"):
+        model = getattr(synthesizer, name, None)
+        if not isinstance(model, torch.nn.Module):
+            continue  # e.g. OnnxVocoder
+        # inplace, FakeTTSWithRawXTTS2 holds another reference to the model
+        torch.ao.quantization.quantize_dynamic(
+            model, QUANTIZED_LAYERS, dtype=torch.qint8, inplace=True
+        )
+        print(colored("Quantized (dynamic int8):", "blue"), type(model).__name__)
+
+
+def measure_rtf(cfg: AppConfig, tts: TTS, text=BENCHMARK_TEXT):
+    """Real-time factor: synthesis time / audio duration. Below 1.0 is real-time"""
+    from server.tts_utils import synthesize_pcm
+
+    sample_rate = tts.synthesizer.output_sample_rate
+    audio_bytes = 0
+    with Timer() as timer:
+        for pcm in synthesize_pcm(cfg, tts, text):
+            audio_bytes += len(pcm)
+    audio_seconds = audio_bytes / 2 / sample_rate
+    return timer.delta / max(audio_seconds, 1e-6)
+
+
+def apply_cpu_profile(cfg: AppConfig, tts: TTS, device: torch.device):
+    """
+    Optimizations for CPU-only inference (`tts.cpu`), skipped on GPU.
+    With `tts.cpu.benchmark`, prints the real-time factor before and after.
+    """
+    cpu_cfg = cfg.tts.cpu
+    if device.type != "cpu" or not (cpu_cfg.quantize or cpu_cfg.benchmark):
+        return
+
+    if cpu_cfg.benchmark:
+        measure_rtf(cfg, tts, "Warm up.")  # first call is always slower
+        rtf = measure_rtf(cfg, tts)
+        print(colored("TTS real-time factor (CPU):", "blue"), f"{rtf:.2f}")
+
+    if cpu_cfg.quantize:
+        quantize_tts(tts)
+        if cpu_cfg.benchmark:
+            measure_rtf(cfg, tts, "Warm up.")
+            rtf_after = measure_rtf(cfg, tts)
+            print(
+                colored("TTS real-time factor after quantization:", "blue"),
+                f"{rtf_after:.2f} (was {rtf:.2f}, {rtf / max(rtf_after, 1e-6):.1f}x faster)",
+            )
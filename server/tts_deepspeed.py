@@ -3,8 +3,13 @@ from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
 from TTS.utils.synthesizer import Synthesizer
 from termcolor import colored
+from typing import Optional
+import torch
 
 from server.config import AppConfig
+from server.speaker_latents import SpeakerLatentStore
+from server.utils import LoadStages
+from server.xtts_streaming import inference_stream_adaptive
 
 
 class FakeTTSWithRawXTTS2:
@@ -21,18 +26,17 @@ class FakeTTSWithRawXTTS2:
         self.model = model  # this model already has deepspeed flag
         self.is_multi_speaker = True
         self.is_multi_lingual = True
-        self.gpt_cond_latent = None
-        self.speaker_embedding = None
+        self.latents = SpeakerLatentStore(model, app_config.tts.speaker_latents_file)
 
-        self.synthesizer = Synthesizer(use_cuda=True)
+        self.synthesizer = Synthesizer(use_cuda=model.device.type == "cuda")
         self.synthesizer.tts_config = tts_config
         self.synthesizer.tts_model = model
         self.synthesizer.output_sample_rate = tts_config.audio["output_sample_rate"]
 
         cloned_voice_wav = app_config.tts.sample_of_cloned_voice_wav
-        self._generate_speaker_embedding_and_latents(model, cloned_voice_wav)
+        self._generate_speaker_embedding_and_latents(cloned_voice_wav)
 
-    def _generate_speaker_embedding_and_latents(self, model, cloned_voice_wav):
+    def _generate_speaker_embedding_and_latents(self, cloned_voice_wav):
         if cloned_voice_wav == None:
             return
         if not self.streaming_enabled:
@@ -42,22 +46,14 @@ class FakeTTSWithRawXTTS2:
             )
             return
 
-        print(colored("Voice clonning:", "blue"), f"'{cloned_voice_wav}'.")
-        gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
-            audio_path=[cloned_voice_wav]
-        )
-        self.gpt_cond_latent = gpt_cond_latent.to(self.model.device)
-        self.speaker_embedding = speaker_embedding.to(self.model.device)
+        # load (or compute) now, so the first request is not slower
+        self.latents.get(None, cloned_voice_wav)
 
-    def _get_speaker_embedding_and_latents(self, speaker_name: str):
+    def _get_speaker_embedding_and_latents(
+        self, speaker_name: str, cloned_voice_wav: Optional[str] = None
+    ):
         """Used only for streaming mode"""
-        if self.gpt_cond_latent == None:
-            speaker = self.model.speaker_manager.speakers.get(speaker_name)
-            gpt_cond_latent = speaker.get("gpt_cond_latent")
-            speaker_embedding = speaker.get("speaker_embedding")
-            self.gpt_cond_latent = gpt_cond_latent.to(self.model.device)
-            self.speaker_embedding = speaker_embedding.to(self.model.device)
-        return self.speaker_embedding, self.gpt_cond_latent
+        return self.latents.get(speaker_name, cloned_voice_wav)
 
     def tts(self, text: str, **kwargs):
         if self.streaming_enabled:
@@ -94,11 +90,24 @@ class FakeTTSWithRawXTTS2:
     def tts_streamed(self, text: str, **kwargs):
         language = kwargs.get("language")
         speaker: str = kwargs.get("speaker")  # type: ignore
+        cloned_voice_wav = kwargs.get("speaker_wav")
 
         speaker_embedding, gpt_cond_latent = self._get_speaker_embedding_and_latents(
-            speaker
+            speaker, cloned_voice_wav
         )
 
+        if self.app_config.tts.streaming_adaptive:
+            yield from inference_stream_adaptive(
+                self.model,
+                self.app_config,
+                text,
+                language,  # type: ignore
+                gpt_cond_latent,
+                speaker_embedding,
+                msg_id=kwargs.get("msg_id"),
+            )
+            return
+
         outputs = self.model.inference_stream(
             text=text,
             language=language,
@@ -132,29 +141,60 @@ def check_deepspeed():
     return deepspeed_available
 
 
-def create_wrapped_xtts(
-    app_config: AppConfig, use_deepspeed=False, use_streaming=False
+def load_xtts_checkpoint(
+    app_config: AppConfig, use_deepspeed: bool, device: str, stages: LoadStages
 ):
+    """Original checkpoint, downloaded if needed"""
     tts = TTS(progress_bar=True)
-    xtts_model_dir, config_path, model_item = tts.manager.download_model(
-        app_config.tts.model_name
-    )
+    with stages.stage("download"):
+        xtts_model_dir, config_path, model_item = tts.manager.download_model(
+            app_config.tts.model_name
+        )
     # print(f"model_path={xtts_model_dir}")
     # print(f"config_path={config_path}")
     # print(f"model_item={model_item}")
 
-    model_config = XttsConfig()
-    model_config.load_json(
-        f"{xtts_model_dir}/config.json"
-    )  # "/path/to/xtts/config.json"
-    model = Xtts.init_from_config(model_config)
-    model.load_checkpoint(
-        model_config,
-        checkpoint_dir=xtts_model_dir,
-        use_deepspeed=use_deepspeed,
-    )
-    # model.to(device)
-    model.cuda()  # let's be honest. You will use deepspeed/streaming with CUDA..
+    with stages.stage("config"):
+        model_config = XttsConfig()
+        model_config.load_json(
+            f"{xtts_model_dir}/config.json"
+        )  # "/path/to/xtts/config.json"
+    with stages.stage("init"):
+        model = Xtts.init_from_config(model_config)
+    with stages.stage("checkpoint"):
+        model.load_checkpoint(
+            model_config,
+            checkpoint_dir=xtts_model_dir,
+            use_deepspeed=use_deepspeed,
+        )
+    with stages.stage("to_device"):
+        model.to(device)
+    return model_config, model
+
+
+def create_wrapped_xtts(
+    app_config: AppConfig, use_deepspeed=False, use_streaming=False
+):
+    from server.xtts_prepared import load_prepared_xtts, read_prepared_manifest
+
+    # let's be honest. You will use deepspeed/streaming with CUDA..
+    device = "cpu"
+    if app_config.tts.use_gpu and torch.cuda.is_available():
+        device = "cuda"
+    else:
+        print(colored("XTTS on CPU:", "yellow"), "'tts.use_gpu' is off or no CUDA")
+
+    stages = LoadStages()
+    loaded = None
+    if app_config.tts.prepared_dir and read_prepared_manifest(app_config):
+        try:
+            loaded = load_prepared_xtts(app_config, use_deepspeed, device, stages)
+        except Exception as e:
+            print(colored("Failed to load the prepared XTTS model:", "red"), e)
+            stages = LoadStages()
+    if loaded is None:
+        loaded = load_xtts_checkpoint(app_config, use_deepspeed, device, stages)
+    model_config, model = loaded
 
     # print("---")
     # print(colored("dir", "blue"), dir(model.speaker_manager))
@@ -165,9 +205,12 @@ def create_wrapped_xtts(
     # print(colored("speakers", "blue"), speaker.keys())
     # exit(0)
 
-    return FakeTTSWithRawXTTS2(
-        app_config, model_config, model, use_streaming=use_streaming
-    )
+    with stages.stage("speaker_latents"):
+        tts = FakeTTSWithRawXTTS2(
+            app_config, model_config, model, use_streaming=use_streaming
+        )
+    stages.log("XTTS load")
+    return tts
 
 
 def raw_xtts_model_required(cfg: AppConfig):
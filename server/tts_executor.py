@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from TTS.api import TTS
+from termcolor import colored
+from typing import AsyncIterator, Optional
+import asyncio
+
+from server.audio_framing import Bytes
+from server.config import AppConfig
+from server.tts_cache import TtsCache
+from server.tts_process_pool import TtsProcessPool
+from server.tts_queue import FairTtsQueue
+from server.tts_utils import synthesize_pcm
+from server.tracing import Tracer
+
+
+class TtsExecutor:
+    """
+    Runs TTS inference (and PCM conversion) on worker threads, so that
+    the asyncio event loop can still serve websockets and HTTP requests.
+
+    - `tts.workers` - number of worker threads.
+    - `tts.processes` - if set, each worker thread delegates to its own
+        worker process instead, see `TtsProcessPool`. `tts` is then None.
+    - sentences from all sessions take turns, see `FairTtsQueue`.
+    - `tts.queue_size` - how many more sentences can wait for a free
+        worker. If the queue is full, `synthesize()` waits.
+    - `tts.cache` - repeated sentences are served from `TtsCache`.
+    """
+
+    def __init__(self, cfg: AppConfig, tts: Optional[TTS], tracer: Tracer):
+        self.cfg = cfg
+        self._tts = tts
+        self._pool = TtsProcessPool(cfg) if cfg.tts.processes else None
+        self._segmenter = None
+        workers = cfg.tts.processes or cfg.tts.workers
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tts_worker"
+        )
+        self._slots = asyncio.Semaphore(workers + cfg.tts.queue_size)
+        self.queue = FairTtsQueue(
+            self._synthesize_sync,
+            lambda: self.sample_rate,
+            self._executor,
+            workers,
+            tracer,
+        )
+        self.cache = TtsCache(cfg) if cfg.tts.cache.enabled else None
+        print(
+            colored("TTS workers:", "blue"),
+            f"{workers} (queue_size={cfg.tts.queue_size})",
+        )
+
+    @property
+    def sample_rate(self) -> int:
+        if self._pool is not None:
+            return self._pool.sample_rate
+        return self._tts.synthesizer.output_sample_rate  # type: ignore
+
+    def split_into_sentences(self, text: str):
+        if self._tts is not None:
+            return self._tts.synthesizer.split_into_sentences(text)
+        # same as TTS.utils.synthesizer.Synthesizer, without loading the model
+        if self._segmenter is None:
+            import pysbd
+
+            self._segmenter = pysbd.Segmenter(language="en", clean=True)
+        return self._segmenter.segment(text)
+
+    async def synthesize(
+        self, sentence: str, session_key: str = "", msg_id: Optional[str] = None
+    ) -> AsyncIterator[Bytes]:
+        """
+        Yields mono int16 PCM (see `sample_rate`). Either the whole
+        sentence or a chunk per streamed part. `session_key` is used
+        for fair scheduling between users.
+        """
+        cache_key = self.cache.key(sentence) if self.cache else None
+        cached = self.cache.get(cache_key) if self.cache else None
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+
+        chunks = []
+        async with self._slots:
+            output = self.queue.synthesize(sentence, session_key, msg_id)
+            async for chunk in output:
+                chunks.append(chunk)
+                yield chunk
+
+        # only reached if the sentence was not cancelled halfway
+        if self.cache and cache_key:
+            self.cache.put(cache_key, chunks)
+            if self.cache.has_disk:
+                loop = asyncio.get_running_loop()
+                loop.run_in_executor(None, self.cache.disk_put, cache_key, chunks)
+
+    async def warm_up(self, text: str):
+        """
+        Synthesize a sentence on each worker, skipping the cache. The first
+        inference is much slower (CUDA kernels, lazy allocations etc.).
+        """
+        sentences = self.split_into_sentences(text)
+
+        async def run(sentence: str, session_key: str):
+            async for _ in self.queue.synthesize(sentence, session_key):
+                pass
+
+        await asyncio.gather(
+            *[
+                run(sentences[i % len(sentences)], f"warm_up_{i}")
+                for i in range(self._workers)
+            ]
+        )
+
+    def _synthesize_sync(self, sentence: str, msg_id: Optional[str] = None):
+        """Runs on the worker thread"""
+        if self._pool is not None:
+            return self._pool.synthesize(sentence, msg_id)
+        return synthesize_pcm(self.cfg, self._tts, sentence, msg_id)  # type: ignore
+
+    def pool_stats(self):
+        return self._pool.stats() if self._pool is not None else None
+
+    def shutdown(self):
+        self.queue.shutdown()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._executor.shutdown(wait=False, cancel_futures=True)
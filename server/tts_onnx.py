@@ -0,0 +1,187 @@
+from TTS.api import TTS
+from termcolor import colored
+from typing import Optional
+import numpy as np
+import os
+import torch
+
+from server.config import AppConfig
+
+ONNX_OPSET = 15
+
+
+def check_onnxruntime():
+    onnxruntime_available = False
+    try:
+        import onnxruntime
+
+        onnxruntime_available = True
+    except ImportError:
+        pass
+    return onnxruntime_available
+
+
+def get_onnx_model_dir(cfg: AppConfig):
+    """Exported files are cached for each model, e.g. 'onnx_cache/tts_models--en--ljspeech--vits'"""
+    model_dir = cfg.tts.model_name.replace("/", "--")
+    return os.path.join(cfg.tts.onnx_dir, model_dir)
+
+
+def create_onnx_session(cfg: AppConfig, filepath: str):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if cfg.tts.cpu.intra_op_threads:
+        options.intra_op_num_threads = cfg.tts.cpu.intra_op_threads
+    if cfg.tts.cpu.inter_op_threads:
+        options.inter_op_num_threads = cfg.tts.cpu.inter_op_threads
+    return onnxruntime.InferenceSession(
+        filepath, options, providers=["CPUExecutionProvider"]
+    )
+
+
+class _VocoderInference(torch.nn.Module):
+    """`vocoder.inference()` as `forward()`, so it can be traced"""
+
+    def __init__(self, vocoder):
+        super().__init__()
+        self.vocoder = vocoder
+
+    def forward(self, c):
+        return self.vocoder.inference(c)
+
+
+class OnnxVocoder:
+    """Drop-in replacement for `synthesizer.vocoder_model`"""
+
+    def __init__(self, cfg: AppConfig, filepath: str):
+        self._session = create_onnx_session(cfg, filepath)
+
+    @staticmethod
+    def export(vocoder, filepath: str):
+        # mel spectrogram: [batch, channels, frames]
+        channels = vocoder.config.audio["num_mels"]
+        dummy_input = torch.randn(1, channels, 100)
+        torch.onnx.export(
+            _VocoderInference(vocoder).eval(),
+            dummy_input,
+            filepath,
+            input_names=["c"],
+            output_names=["wav"],
+            dynamic_axes={
+                "c": {0: "batch", 2: "frames"},
+                "wav": {0: "batch", 2: "samples"},
+            },
+            opset_version=ONNX_OPSET,
+        )
+
+    def inference(self, c: torch.Tensor):
+        c = c.cpu().numpy().astype(np.float32)
+        (wav,) = self._session.run(["wav"], {"c": c})
+        return torch.from_numpy(wav)
+
+
+class OnnxTTS:
+    """
+    Runs the non-XTTS models with ONNX Runtime on CPU. Exposes the same
+    API as `TTS` (`tts()`, `synthesizer` etc.), like `FakeTTSWithRawXTTS2`.
+
+    - VITS (end-to-end, no vocoder) - exported with Coqui's `export_onnx()`.
+    - Acoustic model + vocoder (e.g. tacotron2-DDC + hifigan) - only the
+        vocoder is exported. The autoregressive tacotron2 decoder (dynamic
+        stop condition) cannot be traced, it stays in PyTorch.
+
+    Exported files are written once into `tts.onnx_dir`, per model name.
+    """
+
+    def __init__(self, cfg: AppConfig, tts: TTS):
+        print(colored(f"--- Using custom TTS class {type(self).__name__}--", "blue"))
+        self.cfg = cfg
+        self._tts = tts
+        self.synthesizer = tts.synthesizer
+        self.is_multi_speaker = tts.is_multi_speaker
+        self.is_multi_lingual = tts.is_multi_lingual
+
+        model_dir = get_onnx_model_dir(cfg)
+        os.makedirs(model_dir, exist_ok=True)
+        self._vits = None
+        tts_model = self.synthesizer.tts_model
+        if hasattr(tts_model, "export_onnx"):
+            filepath = os.path.join(model_dir, "model.onnx")
+            OnnxTTS._export_once(filepath, lambda path: tts_model.export_onnx(path))
+            # same as `tts_model.load_onnx()`, but respects `tts.cpu` threads
+            tts_model.onnx_sess = create_onnx_session(cfg, filepath)
+            self._vits = tts_model
+        elif self.synthesizer.vocoder_model is not None:
+            filepath = os.path.join(model_dir, "vocoder.onnx")
+            vocoder = self.synthesizer.vocoder_model
+            OnnxTTS._export_once(
+                filepath, lambda path: OnnxVocoder.export(vocoder, path)
+            )
+            self.synthesizer.vocoder_model = OnnxVocoder(cfg, filepath)
+        else:
+            model_name = type(tts_model).__name__
+            print(
+                colored("ONNX export not supported:", "red"),
+                f"'{model_name}' has no vocoder and no export_onnx(). Using PyTorch.",
+            )
+
+    @staticmethod
+    def _export_once(filepath: str, export_fn):
+        if os.path.exists(filepath):
+            print(colored("ONNX model:", "blue"), f"'{filepath}'")
+            return
+        print(colored("Exporting ONNX model:", "blue"), f"'{filepath}'")
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        export_fn(tmp_path)
+        os.replace(tmp_path, filepath)  # no half-written files if interrupted
+
+    def tts(
+        self,
+        text: str,
+        speaker: Optional[str] = None,
+        language: Optional[str] = None,
+        **kwargs,
+    ):
+        if self._vits is None:
+            # only the vocoder is replaced
+            return self._tts.tts(text=text, speaker=speaker, language=language)
+
+        model = self._vits
+        ids = model.tokenizer.text_to_ids(text, language=language)
+        text_inputs = np.asarray(ids, dtype=np.int64)[None, :]
+        speaker_id = self._name_to_id(model.speaker_manager, speaker)
+        language_id = self._name_to_id(model.language_manager, language)
+        audio = model.inference_onnx(
+            text_inputs, speaker_id=speaker_id, language_id=language_id
+        )
+        return np.asarray(audio, dtype=np.float32).reshape(-1)
+
+    @staticmethod
+    def _name_to_id(manager, name: Optional[str]):
+        if manager is None or name is None or not manager.name_to_id:
+            return None
+        return manager.name_to_id[name]
+
+    def tts_to_file(self, text: str, file_path: str, **kwargs):
+        wav = self.tts(text, **kwargs)
+        self.synthesizer.save_wav(wav=wav, path=file_path, pipe_out=None)
+        return file_path
+
+    def tts_with_vc(self, text: str, **kwargs):
+        raise Exception("Voice cloning is not supported by the ONNX backend")
+
+    def tts_with_vc_to_file(self, text: str, **kwargs):
+        raise Exception("Voice cloning is not supported by the ONNX backend")
+
+
+def create_onnx_tts(cfg: AppConfig) -> Optional[OnnxTTS]:
+    """Returns None if the ONNX backend cannot be used"""
+    if not check_onnxruntime():
+        print(
+            colored("ONNX Runtime is not available.", "red"),
+            "Install 'onnxruntime' (and 'onnx' to export). Using PyTorch.",
+        )
+        return None
+    tts = TTS(model_name=cfg.tts.model_name, gpu=False, progress_bar=True)
+    return OnnxTTS(cfg, tts)
@@ -0,0 +1,296 @@
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from termcolor import colored
+from typing import Iterator, List, Optional
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+
+from server.audio_framing import Bytes
+from server.config import AppConfig
+
+# How often to check if the worker is still alive while waiting for audio
+WORKER_POLL_SECONDS = 1.0
+
+# Messages, parent -> worker:
+#   ("tts", sentence, msg_id)
+#   ("ack", used_bytes)  - parent has copied the chunk out of the ring buffer
+#   ("cancel",)          - stop the current sentence after this chunk
+#   ("stop",)
+# Messages, worker -> parent:
+#   ("ready", sample_rate)
+#   ("chunk", offset, length, used_bytes) - PCM in the ring buffer
+#   ("chunk_inline", pcm) - chunk larger than the ring buffer
+#   ("done",) or ("error", message) - after the last chunk of each sentence
+
+
+class RingWriter:
+    """
+    Worker side of the shared memory ring buffer. The PCM chunk is
+    always contiguous, if it does not fit before the end of the buffer,
+    the tail is skipped (counts as used until acknowledged).
+    """
+
+    def __init__(self, buf: memoryview, conn: Connection):
+        self._buf = buf
+        self._size = len(buf)
+        self._conn = conn
+        self._pos = 0
+        self._in_flight = 0  # bytes not acknowledged by the parent yet
+        self.cancelled = False
+
+    def write(self, pcm: Bytes):
+        n = len(pcm)
+        if n > self._size:
+            self._conn.send(("chunk_inline", bytes(pcm)))
+            return
+
+        offset, skipped = self._pos, 0
+        if offset + n > self._size:
+            offset, skipped = 0, self._size - self._pos
+        used = skipped + n
+        while self._in_flight + used > self._size:
+            self.handle(self._conn.recv())  # wait for the parent to catch up
+
+        self._buf[offset : offset + n] = pcm
+        self._pos = offset + n
+        self._in_flight += used
+        self._conn.send(("chunk", offset, n, used))
+
+    def poll(self):
+        while self._conn.poll():
+            self.handle(self._conn.recv())
+
+    def handle(self, msg):
+        if msg[0] == "ack":
+            self._in_flight -= msg[1]
+        elif msg[0] == "cancel":
+            self.cancelled = True
+
+
+def _worker_main(cfg_dict: dict, shm_name: str, conn: Connection, threads: int):
+    """Entry point of the worker process"""
+    import torch
+    from server.tts_utils import create_tts, synthesize_pcm
+
+    cfg = AppConfig(**cfg_dict)
+    tts = create_tts(cfg)
+    torch.set_num_threads(threads)  # overrides 'tts.cpu.intra_op_threads'
+    shm = SharedMemory(name=shm_name)
+    ring = RingWriter(shm.buf, conn)
+    conn.send(("ready", tts.synthesizer.output_sample_rate))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break  # parent is gone
+        if msg[0] == "stop":
+            break
+        if msg[0] != "tts":
+            ring.handle(msg)  # late 'ack' or 'cancel'
+            continue
+
+        ring.cancelled = False
+        try:
+            for pcm in synthesize_pcm(cfg, tts, msg[1], msg[2]):
+                ring.write(pcm)
+                ring.poll()
+                if ring.cancelled:
+                    break
+            conn.send(("done",))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    del ring
+    shm.close()
+
+
+class TtsWorkerProcess:
+    """Parent side of a single worker process. Use from one thread at a time"""
+
+    def __init__(self, cfg: AppConfig, idx: int, threads: int):
+        self.cfg = cfg
+        self.idx = idx
+        self._threads = threads
+        self._ring_size = cfg.tts.process_ring_mb * 1024 * 1024
+        self._process: Optional[multiprocessing.process.BaseProcess] = None
+        self._conn: Optional[Connection] = None
+        self._shm: Optional[SharedMemory] = None
+        self.sample_rate = 0
+        self.restarts = 0
+        self.broken = False  # pipe closed, the process might still be exiting
+
+    def start(self):
+        # 'spawn' - CUDA does not survive fork, also the only option on Windows
+        ctx = multiprocessing.get_context("spawn")
+        self.broken = False
+        self._shm = SharedMemory(create=True, size=self._ring_size)
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(
+            target=_worker_main,
+            args=(self.cfg.model_dump(), self._shm.name, child_conn, self._threads),
+            name=f"tts_worker_{self.idx}",
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+    def wait_ready(self):
+        try:
+            msg = self._recv()
+        except EOFError:
+            raise Exception(f"TTS worker {self.idx} failed to start, see the log above")
+        if msg[0] != "ready":
+            raise Exception(f"TTS worker {self.idx} failed to start: {msg}")
+        self.sample_rate = msg[1]
+
+    @property
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def needs_restart(self):
+        return self.broken or not self.is_alive
+
+    def synthesize(self, sentence: str, msg_id: Optional[str]) -> Iterator[bytes]:
+        """Yields PCM chunks. Closing the iterator cancels the sentence"""
+        conn: Connection = self._conn  # type: ignore
+        buf = self._shm.buf  # type: ignore
+        conn.send(("tts", sentence, msg_id))
+        finished = False
+        try:
+            while True:
+                msg = self._recv()
+                if msg[0] == "chunk":
+                    _, offset, length, used = msg
+                    pcm = bytes(buf[offset : offset + length])
+                    conn.send(("ack", used))
+                    yield pcm
+                elif msg[0] == "chunk_inline":
+                    yield msg[1]
+                elif msg[0] == "error":
+                    finished = True
+                    raise Exception(f"TTS worker {self.idx}: {msg[1]}")
+                else:
+                    finished = True
+                    return
+        except (EOFError, OSError):
+            self.broken = True
+            raise
+        finally:
+            if not finished and not self.needs_restart:
+                self._cancel()
+
+    def _cancel(self):
+        """Tell the worker to stop, skip the rest of its output"""
+        try:
+            self._conn.send(("cancel",))  # type: ignore
+            while True:
+                msg = self._recv()
+                if msg[0] == "chunk":
+                    self._conn.send(("ack", msg[3]))  # type: ignore
+                elif msg[0] in ("done", "error"):
+                    return
+        except (EOFError, OSError):
+            self.broken = True
+
+    def _recv(self):
+        conn: Connection = self._conn  # type: ignore
+        while not conn.poll(WORKER_POLL_SECONDS):
+            if not self.is_alive:
+                raise EOFError(f"TTS worker {self.idx} has crashed")
+        return conn.recv()
+
+    def stop(self):
+        if self._conn is not None:
+            try:
+                self._conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+            self._conn.close()
+            self._conn = None
+        if self._process is not None and self._process.pid is not None:
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.kill()
+        self._process = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+        self.wait_ready()
+
+
+class TtsProcessPool:
+    """
+    `tts.processes` worker processes, each with its own model and
+    `torch.set_num_threads(tts.process_threads)`. Uses many CPU cores
+    better than a single PyTorch process for small models.
+
+    PCM is returned through a shared memory ring buffer
+    (`tts.process_ring_mb` per worker), only offsets go through the pipe.
+    Each sentence goes to an idle worker. Crashed workers are restarted.
+
+    `synthesize()` is blocking, call it from `FairTtsQueue` worker threads
+    (one thread per process).
+    """
+
+    def __init__(self, cfg: AppConfig):
+        count = cfg.tts.processes
+        threads = cfg.tts.process_threads or max(1, (os.cpu_count() or 1) // count)
+        print(
+            colored("TTS worker processes:", "blue"),
+            f"{count} (torch threads={threads}), loading models..",
+        )
+        self.workers = [TtsWorkerProcess(cfg, i, threads) for i in range(count)]
+        self._idle: queue.Queue[TtsWorkerProcess] = queue.Queue()
+        self._lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+        for worker in self.workers:
+            worker.start()  # load the models in parallel
+        for worker in self.workers:
+            worker.wait_ready()
+            self._idle.put(worker)
+        self.sample_rate = self.workers[0].sample_rate
+
+    def synthesize(
+        self, sentence: str, msg_id: Optional[str] = None
+    ) -> Iterator[bytes]:
+        worker = self._idle.get()
+        try:
+            yield from worker.synthesize(sentence, msg_id)
+        except (EOFError, OSError) as e:
+            print(colored(f"TTS worker {worker.idx} crashed:", "red"), repr(e))
+            raise Exception(f"TTS worker {worker.idx} crashed") from e
+        finally:
+            if worker.needs_restart:
+                print(colored(f"Restarting TTS worker {worker.idx}", "yellow"))
+                try:
+                    worker.restart()
+                except Exception as e:
+                    # keep it in the pool, next sentence will try again
+                    print(colored(f"TTS worker {worker.idx} restart failed:", "red"), e)
+            self._idle.put(worker)
+
+    def stats(self):
+        return {
+            "processes": len(self.workers),
+            "idle": self._idle.qsize(),
+            "restarts": sum(w.restarts for w in self.workers),
+        }
+
+    def shutdown(self):
+        with self._lock:
+            workers: List[TtsWorkerProcess] = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,222 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Executor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Iterator, Optional, Set
+import asyncio
+import time
+
+from server.audio_framing import Bytes
+from server.metrics import METRICS
+from server.tracing import Tracer
+
+SynthesizeFn = Callable[[str, Optional[str]], Iterator[Bytes]]
+
+# PCM chunks of a single sentence that can wait for the caller. The worker
+# thread blocks when the caller does not keep up (e.g. streaming TTS)
+MAX_QUEUED_CHUNKS = 4
+# How often the blocked worker thread checks if the job was cancelled
+CANCEL_POLL_SECONDS = 0.5
+
+
+@dataclass(eq=False)  # hashable, kept in a set while running
+class TtsJob:
+    sentence: str
+    session_key: str
+    msg_id: Optional[str] = None
+    # PCM chunks, then `None` at the end. Exceptions are passed as items too
+    output: asyncio.Queue = field(
+        default_factory=lambda: asyncio.Queue(maxsize=MAX_QUEUED_CHUNKS)
+    )
+    cancelled: bool = False  # read on the worker thread
+    queued_ns: int = field(default_factory=time.time_ns)
+
+
+class QueueStats:
+    def __init__(self):
+        self.sentences = 0
+        self.cancelled = 0
+        self.max_pending = 0
+
+    def to_dict(self):
+        return {
+            "sentences": self.sentences,
+            "cancelled": self.cancelled,
+            "max_pending": self.max_pending,
+        }
+
+
+class FairTtsQueue:
+    """
+    Sentences from all sessions wait here for a free TTS worker. Sessions
+    take turns (round-robin), so a long response does not starve other users.
+    Each sentence runs on its own, Coqui's `TTS.tts()` has no batched inference.
+
+    The audio is streamed back to the caller through a bounded queue
+    (`MAX_QUEUED_CHUNKS`), so the worker does not run ahead of a slow caller.
+    """
+
+    def __init__(
+        self,
+        synthesize: SynthesizeFn,
+        sample_rate: Callable[[], int],
+        executor: Executor,
+        workers: int,
+        tracer: Tracer,
+    ):
+        self._synthesize = synthesize
+        self._sample_rate = sample_rate
+        self._tracer = tracer
+        self._executor = executor
+        self._free_workers = asyncio.Semaphore(workers)
+        # pending jobs for each session, in round-robin order
+        self._pending: OrderedDict[str, Deque[TtsJob]] = OrderedDict()
+        self._has_pending = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[TtsJob] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = QueueStats()
+
+    @property
+    def pending_count(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    async def synthesize(
+        self, sentence: str, session_key: str, msg_id: Optional[str] = None
+    ) -> AsyncIterator[Bytes]:
+        """Yields PCM chunks. Stops the job if the caller stops iterating"""
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+        job = TtsJob(sentence, session_key, msg_id)
+        self._pending.setdefault(session_key, deque()).append(job)
+        self.stats.max_pending = max(self.stats.max_pending, self.pending_count)
+        self._has_pending.set()
+        try:
+            while True:
+                item = await job.output.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            job.cancelled = True  # no-op if already done
+            while not job.output.empty():
+                job.output.get_nowait()  # unblock the worker
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._free_workers.acquire()
+            try:
+                job = await self._next_job()
+            except BaseException:
+                self._free_workers.release()
+                raise
+            task = asyncio.create_task(self._run_job(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _next_job(self):
+        while True:
+            while not self._pending:
+                self._has_pending.clear()
+                await self._has_pending.wait()
+
+            # one sentence from each session, in turns
+            session_key, jobs = next(iter(self._pending.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._pending.move_to_end(session_key)
+            else:
+                del self._pending[session_key]
+
+            if not job.cancelled:
+                return job
+            self.stats.cancelled += 1
+
+    async def _run_job(self, job: TtsJob):
+        self.stats.sentences += 1
+        try:
+            self._running.add(job)
+            loop = asyncio.get_running_loop()
+            rtf = await loop.run_in_executor(
+                self._executor, self._run_job_sync, job, loop
+            )
+            if rtf is not None:
+                METRICS.tts_rtf.observe(rtf)  # event loop thread only
+        finally:
+            self._running.discard(job)
+            self._free_workers.release()
+
+    @staticmethod
+    async def _put(job: TtsJob, item):
+        if not job.cancelled:  # nobody reads the output anymore
+            await job.output.put(item)
+
+    def _put_sync(self, job: TtsJob, item, loop: asyncio.AbstractEventLoop):
+        """Runs on the worker thread. Blocks while the job's output is full"""
+        future = asyncio.run_coroutine_threadsafe(FairTtsQueue._put(job, item), loop)
+        while True:
+            try:
+                return future.result(CANCEL_POLL_SECONDS)
+            except FutureTimeoutError:
+                if job.cancelled:
+                    future.cancel()
+                    return
+
+    def _run_job_sync(self, job: TtsJob, loop: asyncio.AbstractEventLoop):
+        """Runs on the worker thread. Returns the real-time factor to record, if any"""
+        start_ns = time.time_ns()
+        self._tracer.add_span(job.msg_id, "tts.queue_wait", job.queued_ns, start_ns)
+        output = None
+        chunks = 0
+        audio_bytes = 0
+        # time spent in the model, without waiting for a slow caller in `_put_sync`
+        synthesize_ns = 0
+        # not `job.cancelled`, the caller sets it after it has read the last chunk
+        completed = False
+        try:
+            output = self._synthesize(job.sentence, job.msg_id)
+            while not job.cancelled:
+                chunk_start_ns = time.time_ns()
+                pcm = next(output, None)
+                synthesize_ns += time.time_ns() - chunk_start_ns
+                if pcm is None:
+                    completed = True
+                    break
+                self._put_sync(job, pcm, loop)
+                chunks += 1
+                audio_bytes += len(pcm)
+        except Exception as e:
+            self._put_sync(job, e, loop)
+        finally:
+            if output is not None:
+                output.close()  # type: ignore
+        self._put_sync(job, None, loop)
+
+        audio_seconds = audio_bytes / 2 / self._sample_rate()  # int16
+        rtf = synthesize_ns / 1e9 / max(audio_seconds, 1e-6)
+        self._tracer.add_span(
+            job.msg_id,
+            "tts.synthesize",
+            start_ns,
+            chunks=chunks,
+            cancelled=not completed,
+            audio_seconds=audio_seconds,
+            rtf=rtf,
+        )
+        # warm-up has no `msg_id`, its first inference would skew the histogram
+        if job.msg_id is not None and audio_bytes > 0 and completed:
+            return rtf
+        return None
+
+    def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for jobs in self._pending.values():
+            for job in jobs:
+                job.cancelled = True
+        self._pending.clear()
+        for job in self._running:
+            job.cancelled = True  # unblocks the worker threads
@@ -1,10 +1,13 @@
 from TTS.api import TTS
 from server.config import AppConfig
 from termcolor import colored
-from typing import List
+from typing import List, Optional, Union
 import torch
+import types
 
-from server.tts_deepspeed import raw_xtts_model_required
+from server.tts_cpu import apply_cpu_profile, set_torch_threads
+from server.tts_deepspeed import FakeTTSWithRawXTTS2, raw_xtts_model_required
+from server.tts_onnx import create_onnx_tts
 
 
 def get_torch_device(tts: TTS):
@@ -17,14 +20,19 @@ def create_tts(cfg: AppConfig) -> TTS:
 
     model_name = cfg.tts.model_name
     print(colored("TTS model:", "blue"), model_name)
+    set_torch_threads(cfg)
     tts = raw_xtts_model_required(cfg)
-    if tts != None:
-        print(colored("TTS device:", "blue"), get_torch_device(tts))
-        return tts
-
-    # create normal TTS
-    tts = TTS(model_name=model_name, gpu=cfg.tts.use_gpu, progress_bar=True)
-    print(colored("TTS device:", "blue"), get_torch_device(tts))
+    if tts != None and cfg.tts.backend == "onnx":
+        print(colored("ONNX backend does not support XTTS.", "red"), "Using PyTorch.")
+    if tts == None and cfg.tts.backend == "onnx":
+        tts = create_onnx_tts(cfg)
+    if tts == None:
+        # create normal TTS
+        tts = TTS(model_name=model_name, gpu=cfg.tts.use_gpu, progress_bar=True)
+
+    device = get_torch_device(tts)
+    print(colored("TTS device:", "blue"), device)
+    apply_cpu_profile(cfg, tts, device)
     return tts
 
 
@@ -55,8 +63,10 @@ def get_tts_options(cfg: AppConfig, tts: TTS):
     return is_cloning, kw
 
 
-def exec_tts(cfg: AppConfig, tts: TTS, text: str):
+def exec_tts(cfg: AppConfig, tts: TTS, text: str, msg_id: Optional[str] = None):
     is_cloning, tts_kwargs = get_tts_options(cfg, tts)
+    if msg_id and isinstance(tts, FakeTTSWithRawXTTS2):
+        tts_kwargs["msg_id"] = msg_id  # for logs
 
     if is_cloning:
         wav = tts.tts_with_vc(text=text, **tts_kwargs)
@@ -66,6 +76,31 @@ def exec_tts(cfg: AppConfig, tts: TTS, text: str):
     return wav
 
 
+def synthesize_pcm(cfg: AppConfig, tts: TTS, text: str, msg_id: Optional[str] = None):
+    """Yields mono int16 PCM. Either the whole sentence or a chunk per streamed part"""
+    # No autograd bookkeeping. It's a thread-local mode, so it's only active
+    # while the model runs, never held across a `yield` (the caller's code)
+    inference_mode = cfg.tts.inference_mode
+    with torch.inference_mode(inference_mode):
+        output = exec_tts(cfg, tts, text, msg_id)  # either object or generator
+
+    if not isinstance(output, types.GeneratorType):
+        # when not streaming
+        yield wav2pcm(output, normalize=True)
+        return
+
+    # when streaming, the model runs on each `next()`
+    try:
+        while True:
+            with torch.inference_mode(inference_mode):
+                chunk = next(output, None)
+            if chunk is None:
+                break
+            yield wav2pcm(chunk, normalize=False)
+    finally:
+        output.close()
+
+
 def exec_tts_to_file(
     cfg: AppConfig, tts: TTS, text: str, out_file_path: str, verbose=False
 ):
@@ -84,38 +119,28 @@ def exec_tts_to_file(
     return wav
 
 
-def wav2bytes(tts: TTS, wav: List[int]):
-    import io
+def wav2pcm(wav: Union[List[float], torch.Tensor], normalize: bool):
+    """
+    Convert TTS output to mono int16 PCM. Returns bytes view of the numpy buffer.
 
-    out = io.BytesIO()
-    tts.synthesizer.save_wav(wav, out)
-    return out.getbuffer()
-
-
-def wav2bytes_streamed(tts: TTS, chunk: torch.Tensor):
+    - `normalize=True` - scale to peak volume. Same as `tts.synthesizer.save_wav()`.
+        Used for whole sentences.
+    - `normalize=False` - clip to [-1, 1]. Used for streamed chunks, as
+        each chunk would have a different volume otherwise.
+    """
     import torch
     import numpy as np
-    import io
-    import scipy
-
-    # from
-
-    if isinstance(chunk, list):
-        chunk = torch.cat(chunk, dim=0)
-    chunk = chunk.clone().detach().cpu().numpy()
-    if isinstance(chunk, list):
-        chunk = np.array(chunk)
-    # chunk = chunk[None, : int(chunk.shape[0])]
-    chunk = np.clip(chunk, -1, 1)
-    chunk = (chunk * 32767).astype(np.int16)
-
-    # based on:
-    # - `tts.synthesizer.save_wav(chunk, out)`
-    # - `TTS.utils.audio.numpy_transforms import save_wav`
-    out = io.BytesIO()
-    sample_rate = tts.synthesizer.output_sample_rate
-    scipy.io.wavfile.write(out, sample_rate, chunk)
-
-    # chunk_duration = len(chunk_bytes) / (4 * sample_rate)  # 4 bytes per sample, 24000 Hz
-    # generated_seconds += chunk_duration
-    return out.getbuffer()
+
+    if isinstance(wav, list) and len(wav) > 0 and torch.is_tensor(wav[0]):
+        wav = torch.cat(wav, dim=0)
+    if torch.is_tensor(wav):
+        wav = wav.detach().cpu().numpy()
+    wav = np.asarray(wav, dtype=np.float32)
+
+    if normalize:
+        # TTS.utils.audio.numpy_transforms.save_wav
+        wav = wav * (32767 / max(0.01, np.max(np.abs(wav))))
+    else:
+        wav = np.clip(wav, -1, 1) * 32767
+    pcm = wav.astype("<i2")
+    return memoryview(pcm).cast("B")
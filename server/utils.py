@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+from termcolor import colored
 from timeit import default_timer as timer
-import asyncio, threading
+from typing import Dict
+import re
 
 
 def seconds_to_str(sec: float):
@@ -45,46 +48,39 @@ class Timer:
         self.stop()
 
 
+class LoadStages:
+    """Seconds spent in each stage of e.g. the model load"""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        with Timer() as t:
+            yield
+        self.seconds[name] = self.seconds.get(name, 0.0) + t.delta
+
+    def log(self, title: str):
+        total = sum(self.seconds.values())
+        stages = ", ".join(f"{k}={v:.2f}s" for k, v in self.seconds.items())
+        print(colored(f"{title}:", "blue"), f"{seconds_to_str(total)} ({stages})")
+
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str):
+    """
+    Fast approximation of the LLM token count, without loading the tokenizer.
+    Each word and punctuation mark is a token, but at least 1 token per
+    4 characters (a usual ratio for BPE/SentencePiece on English text).
+    """
+    return max(len(TOKEN_RE.findall(text)), len(text) // 4)
+
+
 def generate_id():
     import random
     import string
 
     length = 8
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
-
-
-def async_wrap_iter(it):
-    """Wrap blocking iterator into an asynchronous one.
-    Not used ATM, but it's generally quite usefull in itself.
-
-    https://stackoverflow.com/a/62297994
-    """
-    loop = asyncio.get_event_loop()
-    q = asyncio.Queue(1)
-    exception = None
-    _END = object()
-
-    async def yield_queue_items():
-        while True:
-            next_item = await q.get()
-            if next_item is _END:
-                break
-            yield next_item
-        if exception is not None:
-            # the iterator has raised, propagate the exception
-            raise exception
-
-    def iter_to_queue():
-        nonlocal exception
-        try:
-            for item in it:
-                # This runs outside the event loop thread, so we
-                # must use thread-safe API to talk to the queue.
-                asyncio.run_coroutine_threadsafe(q.put(item), loop).result()
-        except Exception as e:
-            exception = e
-        finally:
-            asyncio.run_coroutine_threadsafe(q.put(_END), loop).result()
-
-    threading.Thread(target=iter_to_queue).start()
-    return yield_queue_items()
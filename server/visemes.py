@@ -0,0 +1,111 @@
+from typing import Tuple
+import numpy as np
+
+from server.audio_framing import VISEME_HEADER, Bytes
+
+# Same order as 'OVRLipSync.Viseme' in the Unity client
+# fmt: off
+VISEME_NAMES = (
+    "sil", "PP", "FF", "TH", "DD", "kk", "CH", "SS",
+    "nn", "RR", "aa", "E", "ih", "oh", "ou",
+)
+# fmt: on
+VISEME_FRAME_MS = 10
+
+# energy: RMS in dBFS mapped linearly from [SILENCE_DB, LOUD_DB] to [0, 1]
+SILENCE_DB = -50.0
+LOUD_DB = -10.0
+# Hz. Formants are estimated as the spectral centroid of their band
+F1_BAND = (200, 1000)
+F2_BAND = (800, 2800)
+VOICED_BAND = (80, 3000)
+FRICATIVE_BAND = (4000, 12000)
+# Hz, typical (F1, F2) of each vowel viseme
+VOWEL_FORMANTS = {
+    "aa": (750, 1200),
+    "E": (550, 1900),
+    "ih": (350, 2200),
+    "oh": (500, 900),
+    "ou": (320, 800),
+}
+VOWEL_SPREAD = (150, 400)  # Hz, (F1, F2)
+
+
+def compute_visemes(
+    pcm: Bytes, sample_rate: int, frame_ms: int = VISEME_FRAME_MS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Energy envelope `[frames]` and viseme weights `[frames, len(VISEME_NAMES)]`
+    for mono int16 PCM, one row for each `frame_ms` (the last frame is zero
+    padded). Vectorized over the whole chunk: a single batched FFT.
+
+    This is a spectral heuristic, not phoneme recognition. Loudness drives
+    'sil' vs the rest, the estimated first two formants pick the vowel ('aa',
+    'E', 'ih', 'oh', 'ou') and high frequency noise maps to 'SS'. Other
+    consonants stay at 0. Rows sum to 1, like the Oculus Lipsync output.
+    """
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32768.0
+    frame_len = max(1, sample_rate * frame_ms // 1000)
+    frame_count = -(-len(samples) // frame_len)  # ceil
+    if frame_count == 0:
+        empty = np.zeros(0, dtype=np.float16)
+        return empty, np.zeros((0, len(VISEME_NAMES)), dtype=np.float16)
+
+    frames = np.zeros(frame_count * frame_len, dtype=np.float32)
+    frames[: len(samples)] = samples
+    frames = frames.reshape(frame_count, frame_len)
+
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    db = 20.0 * np.log10(rms + 1e-9)
+    energy = np.clip((db - SILENCE_DB) / (LOUD_DB - SILENCE_DB), 0.0, 1.0)
+
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_len), axis=1)) ** 2
+    freqs = np.fft.rfftfreq(frame_len, 1.0 / sample_rate)
+    bands = (F1_BAND, F2_BAND, VOICED_BAND, FRICATIVE_BAND)
+    masks = np.stack([(freqs >= lo) & (freqs < hi) for lo, hi in bands])
+    masks = masks.astype(np.float32)
+    # all bands of all frames in 2 matrix products: power and power * frequency
+    power = spectrum @ masks.T + 1e-12
+    weighted = spectrum @ (masks * freqs).T
+    f1 = weighted[:, 0] / power[:, 0]
+    f2 = weighted[:, 1] / power[:, 1]
+    fricative = power[:, 3] / (power[:, 2] + power[:, 3])
+
+    vowels = np.stack(
+        [
+            np.exp(
+                -0.5 * ((f1 - vf1) / VOWEL_SPREAD[0]) ** 2
+                - 0.5 * ((f2 - vf2) / VOWEL_SPREAD[1]) ** 2
+            )
+            for vf1, vf2 in VOWEL_FORMANTS.values()
+        ],
+        axis=1,
+    )
+    vowels /= np.maximum(vowels.sum(axis=1, keepdims=True), 1e-6)
+
+    visemes = np.zeros((frame_count, len(VISEME_NAMES)), dtype=np.float32)
+    vowel_idx = [VISEME_NAMES.index(name) for name in VOWEL_FORMANTS]
+    visemes[:, vowel_idx] = vowels * (energy * (1.0 - fricative))[:, None]
+    visemes[:, VISEME_NAMES.index("SS")] = energy * fricative
+    visemes[:, VISEME_NAMES.index("sil")] = 1.0 - energy
+    visemes /= np.maximum(visemes.sum(axis=1, keepdims=True), 1e-6)
+
+    return energy.astype(np.float16), visemes.astype(np.float16)
+
+
+def encode_visemes(energy: np.ndarray, visemes: np.ndarray, frame_ms: int):
+    """Block prepended to the frame payload, see `FRAME_FLAG_VISEMES`"""
+    header = VISEME_HEADER.pack(len(energy), visemes.shape[1], frame_ms)
+    return header + energy.astype("<f2").tobytes() + visemes.astype("<f2").tobytes()
+
+
+def decode_visemes(data: Bytes, offset: int = 0):
+    """Returns `(energy, visemes, frame_ms, audio_offset)`"""
+    frame_count, viseme_count, frame_ms = VISEME_HEADER.unpack_from(data, offset)
+    offset += VISEME_HEADER.size
+    energy = np.frombuffer(data, dtype="<f2", count=frame_count, offset=offset)
+    offset += energy.nbytes
+    count = frame_count * viseme_count
+    visemes = np.frombuffer(data, dtype="<f2", count=count, offset=offset)
+    offset += visemes.nbytes
+    return energy, visemes.reshape(frame_count, viseme_count), frame_ms, offset
@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+from TTS.tts.configs.xtts_config import XttsConfig
+from TTS.tts.models.xtts import Xtts
+from termcolor import colored
+from typing import Optional, Tuple
+import json
+import os
+import shutil
+import torch
+
+from server.config import AppConfig
+from server.utils import LoadStages
+
+PREPARED_MANIFEST = "prepared.json"
+PREPARED_WEIGHTS = "model.safetensors"
+PREPARED_CONFIG = "config.json"
+# copied as-is from the checkpoint dir. 'model.pth' is replaced by the weights
+XTTS_FILES = ("vocab.json", "speakers_xtts.pth")
+
+# Prepared XTTS model: the original checkpoint is a ~1.8GB pickle that is
+# unpickled into CPU memory, filtered, then copied into randomly initialized
+# modules. The prepared one is:
+#
+#   - 'model.safetensors' - state dict of the loaded model. Memory-mapped and
+#       copied straight into the parameters on the target device.
+#   - 'config.json' - resolved 'XttsConfig'.
+#   - 'vocab.json', 'speakers_xtts.pth' - tokenizer and speakers.
+#   - 'prepared.json' - manifest, written last. Stale if the model name
+#       or the Coqui TTS version has changed.
+#
+# DeepSpeed kernel injection cannot be serialized, it still runs on each start.
+
+
+def get_prepared_model_dir(cfg: AppConfig):
+    """Prepared files for each model, e.g. 'prepared_models/tts_models--multilingual--multi-dataset--xtts_v2'"""
+    model_dir = cfg.tts.model_name.replace("/", "--")
+    return os.path.join(cfg.tts.prepared_dir or "", model_dir)
+
+
+def _tts_version():
+    from TTS import __version__
+
+    return __version__
+
+
+def download_xtts(cfg: AppConfig) -> str:
+    """Returns the directory with the original checkpoint"""
+    from TTS.api import TTS
+
+    tts = TTS(progress_bar=True)
+    xtts_model_dir, _config_path, _model_item = tts.manager.download_model(
+        cfg.tts.model_name
+    )
+    return xtts_model_dir
+
+
+def load_xtts_config(filepath: str):
+    model_config = XttsConfig()
+    model_config.load_json(filepath)
+    return model_config
+
+
+def prepare_xtts(cfg: AppConfig, out_dir: str):
+    """Convert the original XTTS checkpoint into the prepared model in `out_dir`"""
+    from safetensors.torch import save_model
+
+    stages = LoadStages()
+    with stages.stage("download"):
+        xtts_model_dir = download_xtts(cfg)
+    with stages.stage("init"):
+        model_config = load_xtts_config(os.path.join(xtts_model_dir, "config.json"))
+        model = Xtts.init_from_config(model_config)
+    with stages.stage("checkpoint"):
+        # no 'gpt_inference' wrapper, it's created when the prepared model is loaded
+        model.load_checkpoint(
+            model_config, checkpoint_dir=xtts_model_dir, eval=False, use_deepspeed=False
+        )
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, PREPARED_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)  # invalid until all files are written
+
+    with stages.stage("write"):
+        weights_path = os.path.join(out_dir, PREPARED_WEIGHTS)
+        tmp_path = f"{weights_path}.{os.getpid()}.tmp"
+        save_model(model, tmp_path)  # also dedupes shared (tied) tensors
+        os.replace(tmp_path, weights_path)
+        model_config.save_json(os.path.join(out_dir, PREPARED_CONFIG))
+        for filename in XTTS_FILES:
+            src_path = os.path.join(xtts_model_dir, filename)
+            if os.path.exists(src_path):
+                shutil.copyfile(src_path, os.path.join(out_dir, filename))
+
+        manifest = {
+            "model_name": cfg.tts.model_name,
+            "tts_version": _tts_version(),
+            "torch_version": torch.__version__,
+            "weights_bytes": os.path.getsize(weights_path),
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    stages.log("XTTS prepare")
+    return manifest
+
+
+def read_prepared_manifest(cfg: AppConfig) -> Optional[dict]:
+    """None if there is no prepared model, or it was made for a different model or library version"""
+    model_dir = get_prepared_model_dir(cfg)
+    filepath = os.path.join(model_dir, PREPARED_MANIFEST)
+    if not os.path.exists(filepath):
+        print(
+            colored("No prepared XTTS model:", "yellow"),
+            f"'{model_dir}'. Run 'main.py prepare-xtts' for a faster startup.",
+        )
+        return None
+
+    with open(filepath, "r") as f:
+        manifest = json.load(f)
+    expected = {"model_name": cfg.tts.model_name, "tts_version": _tts_version()}
+    for key, value in expected.items():
+        if manifest.get(key) != value:
+            print(
+                colored("Prepared XTTS model is stale:", "yellow"),
+                f"{key}='{manifest.get(key)}', expected '{value}'.",
+                "Run 'main.py prepare-xtts' again.",
+            )
+            return None
+    return manifest
+
+
+@contextmanager
+def _skip_weight_init():
+    """
+    Random init of ~500M parameters is wasted work if all of them are
+    overwritten right after (`load_model(strict=True)` checks that).
+    """
+    init = torch.nn.init
+    names = [
+        "uniform_",
+        "normal_",
+        "trunc_normal_",
+        "kaiming_uniform_",
+        "kaiming_normal_",
+        "xavier_uniform_",
+        "xavier_normal_",
+        "orthogonal_",
+    ]
+    originals = {name: getattr(init, name) for name in names}
+    for name in names:
+        setattr(init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(init, name, fn)
+
+
+@contextmanager
+def _default_device(device: str):
+    """
+    New modules allocate their tensors straight on the `device`, instead of
+    on CPU followed by a copy. Needs torch>=2.0, no-op on older versions.
+    """
+    target = torch.device(device)
+    if not hasattr(target, "__enter__"):
+        yield
+        return
+    with target:
+        yield
+
+
+def load_prepared_xtts(
+    cfg: AppConfig, use_deepspeed: bool, device: str, stages: LoadStages
+) -> Tuple[XttsConfig, Xtts]:
+    """Same result as `Xtts.load_checkpoint()` followed by `model.to(device)`"""
+    from safetensors.torch import load_model
+    from TTS.tts.layers.xtts.tokenizer import VoiceBpeTokenizer
+    from TTS.tts.layers.xtts.xtts_manager import LanguageManager, SpeakerManager
+
+    model_dir = get_prepared_model_dir(cfg)
+    print(colored("Prepared XTTS model:", "blue"), f"'{model_dir}'")
+
+    with stages.stage("config"):
+        model_config = load_xtts_config(os.path.join(model_dir, PREPARED_CONFIG))
+    with stages.stage("init"), _skip_weight_init(), _default_device(device):
+        model = Xtts.init_from_config(model_config)
+        model.language_manager = LanguageManager(model_config)
+        model.speaker_manager = None
+        speakers_path = os.path.join(model_dir, "speakers_xtts.pth")
+        if os.path.exists(speakers_path):
+            model.speaker_manager = SpeakerManager(speakers_path)
+        model.tokenizer = VoiceBpeTokenizer(
+            vocab_file=os.path.join(model_dir, "vocab.json")
+        )
+        model.init_models()  # needs the tokenizer
+    with stages.stage("weights"):
+        # memory-mapped, each tensor is copied straight to the `device`
+        weights_path = os.path.join(model_dir, PREPARED_WEIGHTS)
+        load_model(model, weights_path, strict=True, device=device)
+    with stages.stage("to_device"):
+        # no-op for tensors already on the `device`. Moves the ones created
+        # outside of the torch factory functions (or all of them, torch<2.0)
+        model.to(device)
+    with stages.stage("inference_init"):
+        # same as the end of `Xtts.load_checkpoint(eval=True)`. Includes DeepSpeed
+        model.hifigan_decoder.eval()
+        model.gpt.init_gpt_for_inference(
+            kv_cache=model.args.kv_cache, use_deepspeed=use_deepspeed
+        )
+        model.gpt.eval()
+    return model_config, model
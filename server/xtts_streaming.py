@@ -0,0 +1,150 @@
+from termcolor import colored
+from typing import List, Optional
+import torch
+import torch.nn.functional as F
+
+from server.config import AppConfig
+from server.utils import Timer
+
+XTTS_SAMPLE_RATE = 24000
+RTF_SMOOTHING = 0.5  # weight of the latest chunk in the moving average
+
+
+class AdaptiveChunkSize:
+    """
+    Number of GPT tokens in the next streamed chunk, based on the
+    real-time factor (generation time / audio duration) of recent chunks.
+
+    - Starts with `tts.streaming_min_chunk_size`, for fast first sound.
+    - Model runs ahead (RTF well below `tts.streaming_target_rtf`) -
+        grow, fewer chunk transitions and less decoder overhead.
+    - Model falls behind (RTF above target) - shrink, so the next
+        audio arrives before the client runs out of it.
+    - Always within `[streaming_min_chunk_size, streaming_max_chunk_size]`.
+    """
+
+    GROW_FACTOR = 1.5
+    SHRINK_FACTOR = 0.5
+
+    def __init__(self, cfg: AppConfig):
+        tts_cfg = cfg.tts
+        self.min_size = tts_cfg.streaming_min_chunk_size
+        self.max_size = max(tts_cfg.streaming_max_chunk_size, self.min_size)
+        self.target_rtf = tts_cfg.streaming_target_rtf
+        self.size = self.min_size
+        self.rtf: Optional[float] = None  # moving average
+        self.history: List[str] = []  # decisions, for the log
+
+    def update(self, tokens: int, elapsed: float, audio_seconds: float):
+        """Call after each chunk. Returns chunk size for the next one"""
+        rtf = elapsed / max(audio_seconds, 1e-6)
+        if self.rtf is None:
+            self.rtf = rtf
+        else:
+            self.rtf = RTF_SMOOTHING * rtf + (1 - RTF_SMOOTHING) * self.rtf
+
+        old_size = self.size
+        if self.rtf < self.target_rtf / AdaptiveChunkSize.GROW_FACTOR:
+            self.size = min(self.max_size, int(self.size * self.GROW_FACTOR) + 1)
+        elif self.rtf > self.target_rtf:
+            self.size = max(self.min_size, int(self.size * self.SHRINK_FACTOR))
+
+        decision = "keep"
+        if self.size > old_size:
+            decision = "grow"
+        elif self.size < old_size:
+            decision = "shrink"
+        self.history.append(f"{tokens}tok@rtf={rtf:.2f}->{decision}")
+        return self.size
+
+    def log(self, msg_id: Optional[str]):
+        print(
+            colored("Adaptive streaming:", "blue"),
+            f"msg_id={msg_id} chunks=[{', '.join(self.history)}]",
+        )
+
+
+@torch.inference_mode()
+def inference_stream_adaptive(
+    model,
+    cfg: AppConfig,
+    text: str,
+    language: str,
+    gpt_cond_latent: torch.Tensor,
+    speaker_embedding: torch.Tensor,
+    msg_id: Optional[str] = None,
+    temperature=0.75,
+    length_penalty=1.0,
+    repetition_penalty=10.0,
+    top_k=50,
+    top_p=0.85,
+    do_sample=True,
+    speed=1.0,
+):
+    """
+    Same as `Xtts.inference_stream()` (TTS 0.22), but the chunk size is
+    chosen by `AdaptiveChunkSize` before each chunk instead of being fixed.
+    Expects a single sentence (no text splitting).
+    """
+    overlap_wav_len = cfg.tts.streaming_overlap_wav_len
+    chunk_size = AdaptiveChunkSize(cfg)
+    language = language.split("-")[0]  # remove the country code
+    length_scale = 1.0 / max(speed, 0.05)
+    device = model.device
+    gpt_cond_latent = gpt_cond_latent.to(device)
+    speaker_embedding = speaker_embedding.to(device)
+
+    text = text.strip().lower()
+    text_tokens = model.tokenizer.encode(text, lang=language)
+    text_tokens = torch.IntTensor(text_tokens).unsqueeze(0).to(device)
+    fake_inputs = model.gpt.compute_embeddings(gpt_cond_latent, text_tokens)
+    gpt_generator = model.gpt.get_generator(
+        fake_inputs=fake_inputs,
+        top_k=top_k,
+        top_p=top_p,
+        temperature=temperature,
+        do_sample=do_sample,
+        num_beams=1,
+        num_return_sequences=1,
+        length_penalty=float(length_penalty),
+        repetition_penalty=float(repetition_penalty),
+        output_attentions=False,
+        output_hidden_states=True,
+    )
+
+    last_tokens = 0
+    all_latents = []
+    wav_gen_prev, wav_overlap = None, None
+    is_end = False
+    timer = Timer(start=True)
+    while not is_end:
+        try:
+            _, latent = next(gpt_generator)
+            last_tokens += 1
+            all_latents.append(latent)
+        except StopIteration:
+            is_end = True
+
+        if is_end or last_tokens >= chunk_size.size:
+            if not all_latents:
+                break
+            gpt_latents = torch.cat(all_latents, dim=0)[None, :]
+            if length_scale != 1.0:
+                gpt_latents = F.interpolate(
+                    gpt_latents.transpose(1, 2),
+                    scale_factor=length_scale,
+                    mode="linear",
+                ).transpose(1, 2)
+            wav_gen = model.hifigan_decoder(gpt_latents, g=speaker_embedding)
+            wav_chunk, wav_gen_prev, wav_overlap = model.handle_chunks(
+                wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
+            )
+
+            elapsed = timer.stop()
+            audio_seconds = wav_chunk.shape[-1] / XTTS_SAMPLE_RATE
+            chunk_size.update(last_tokens, elapsed, audio_seconds)
+            last_tokens = 0
+            yield wav_chunk
+            timer.start()  # do not count the time spent by the consumer
+
+    chunk_size.log(msg_id)
@@ -0,0 +1,93 @@
+from termcolor import colored
+from typing import List, Optional
+import click
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# a hung command (e.g. waiting for input) counts as too slow
+COMMAND_TIMEOUT_SECONDS = 60
+
+
+def print_slowest_imports(args: List[str], count=10):
+    """Top-level imports by cumulative time, from 'python -X importtime'"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", MAIN_PY, *args],
+        capture_output=True,
+        text=True,
+    )
+    imports = []
+    for line in out.stderr.splitlines():
+        # 'import time: self [us] | cumulative | imported package'
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        name = parts[2]
+        if name.startswith("  ") or not parts[1].strip().isdigit():
+            continue  # nested import, already counted in the parent
+        imports.append((int(parts[1]), name.strip()))
+    print(colored("Slowest imports:", "yellow"))
+    for cumulative_us, name in sorted(imports, reverse=True)[:count]:
+        print(f"  {cumulative_us / 1e6:.3f}s {name}")
+
+
+def time_command(args: List[str]):
+    """Returns seconds, or raises `RuntimeError` with the command's error output"""
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, MAIN_PY, *args],
+        capture_output=True,
+        text=True,
+        timeout=COMMAND_TIMEOUT_SECONDS,
+    )
+    elapsed = time.perf_counter() - start
+    if out.returncode != 0:
+        output = out.stderr.strip() or out.stdout.strip()
+        lines = output.splitlines()[-5:]  # e.g. end of the traceback
+        raise RuntimeError(f"exit code {out.returncode}\n" + "\n".join(lines))
+    return elapsed
+
+
+@click.command()
+@click.option(
+    "--config",
+    "-c",
+    type=click.Path(exists=True),
+    help="Also check 'validate-config' with this file",
+)
+@click.option("--max-seconds", default=1.0, help="Budget for each command")
+@click.option("--runs", default=3, help="Median of this many runs")
+def check_startup(config: Optional[str], max_seconds: float, runs: int):
+    """Fail if '--help' or 'validate-config' start slower than the budget"""
+    commands = [["--help"]]
+    if config:
+        commands.append(["validate-config", "--config", config])
+
+    failed = False
+    for args in commands:
+        cmd = " ".join(["main.py", *args])
+        try:
+            times = [time_command(args) for _ in range(runs)]
+        except subprocess.TimeoutExpired as e:
+            failed = True
+            print(colored("TOO SLOW:", "red"), f"'{cmd}' timed out after {e.timeout}s")
+            continue
+        except RuntimeError as e:
+            failed = True
+            print(colored("FAILED:", "red"), f"'{cmd}'", e)
+            continue
+
+        median = statistics.median(times)
+        result = f"'{cmd}' {median:.2f}s (max {max_seconds}s)"
+        if median <= max_seconds:
+            print(colored("OK:", "green"), result)
+        else:
+            failed = True
+            print(colored("TOO SLOW:", "red"), result)
+            print_slowest_imports(args)
+
+    if failed:
+        exit(1)
@@ -1,15 +1,9 @@
-from typing import Optional
+from typing import Optional, Tuple
 from termcolor import colored
-from tqdm import tqdm
 import click
 import os.path
 
-from server.tts_utils import (
-    create_tts,
-    exec_tts_to_file,
-    get_tts_options,
-    list_speakers as list_speakers_util,
-)
+# TTS and torch are imported inside each command, see 'main.py'
 from server.config import load_app_config
 
 DEFAULT_TEXT = "The current algorithm only upscales the luma, the chroma is preserved as-is. This is a common trick known"
@@ -22,6 +16,12 @@ DEFAULT_TEXT = "The current algorithm only upscales the luma, the chroma is pres
 )
 def create_speaker_samples(config: str, voice: Optional[str]):
     """Generate samples for each speaker in the TTS model. Supports voice cloning."""
+    from tqdm import tqdm
+    from server.tts_utils import (
+        create_tts,
+        get_tts_options,
+        list_speakers as list_speakers_util,
+    )
 
     cfg = load_app_config(config)
     cfg.tts.streaming_enabled = False
@@ -68,6 +68,7 @@ def create_speaker_samples(config: str, voice: Optional[str]):
 )
 def speak(config: str, input: str, voice: Optional[str]):
     """Speak the text and write the result into the file. Can also voice-clone."""
+    from server.tts_utils import create_tts, exec_tts_to_file
 
     cfg = load_app_config(config)
     cfg.tts.streaming_enabled = False
@@ -84,3 +85,59 @@ def speak(config: str, input: str, voice: Optional[str]):
     print(colored("Will write result to:", "blue"), out_file_path)
 
     exec_tts_to_file(cfg, tts, text, out_file_path, verbose=True)
+
+
+@click.command()
+@click.option("--config", "-c", help="Config file")
+@click.option("--output", "-o", required=True, help="Output .safetensors file")
+@click.option(
+    "--voice",
+    "-v",
+    type=click.Path(exists=True),
+    multiple=True,
+    help="Cloned voice to include. Can be used many times",
+)
+def precompute_speaker_latents(config: str, output: str, voice: Tuple[str, ...]):
+    """Precompute XTTS latents of all speakers and cloned voices into a single file."""
+    from server.speaker_latents import SpeakerLatentStore
+    from server.tts_utils import create_tts, list_speakers as list_speakers_util
+
+    cfg = load_app_config(config)
+    cfg.tts.streaming_enabled = False
+    cfg.tts.speaker_latents_file = None
+    tts = create_tts(cfg)
+    if "xtts" not in cfg.tts.model_name:
+        print(colored("Speaker latents are only used by XTTS", "red"))
+        exit(1)
+
+    speakers = list_speakers_util(tts)
+    voices = list(voice)
+    if cfg.tts.sample_of_cloned_voice_wav:
+        voices.append(cfg.tts.sample_of_cloned_voice_wav)
+    print(colored("TTS speakers:", "blue"), len(speakers))
+    print(colored("Cloned voices:", "blue"), voices)
+
+    store = SpeakerLatentStore(tts.synthesizer.tts_model)
+    store.save(output, speakers, voices)
+    print(colored("Written speaker latents to:", "blue"), f"'{output}'")
+
+
+@click.command()
+@click.option("--config", "-c", help="Config file")
+def prepare_xtts(config: str):
+    """Convert XTTS checkpoint into 'tts.prepared_dir' for a faster server start."""
+    from server.xtts_prepared import get_prepared_model_dir, prepare_xtts as prepare
+
+    cfg = load_app_config(config)
+    if "xtts" not in cfg.tts.model_name:
+        print(colored("Only XTTS models can be prepared", "red"))
+        exit(1)
+    if not cfg.tts.prepared_dir:
+        print(colored("Set 'tts.prepared_dir' in the config", "red"))
+        exit(1)
+
+    out_dir = get_prepared_model_dir(cfg)
+    print(colored("Will write prepared model to:", "blue"), f"'{out_dir}'")
+    manifest = prepare(cfg, out_dir)
+    size_mb = manifest["weights_bytes"] / 1024 / 1024
+    print(colored("Written prepared model:", "blue"), f"'{out_dir}' ({size_mb:.0f}MB)")